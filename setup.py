@@ -46,6 +46,7 @@ setup(
     },
     entry_points={
         'console_scripts': [
+            'fake-directory = gocept.net.fakedirectory:main',
             'list-maintenance = gocept.net.maintenance.script:list',
             'localconfig-backy = gocept.net.configure.backy:configure',
             'localconfig-bacula-purge = gocept.net.configure.bacula:purge',
@@ -1,8 +1,160 @@
 import cStringIO
-import difflib
+import collections
+import ctypes
+import ctypes.util
+import errno
 import fcntl
+import fnmatch
+import gocept.net.diff
+import hashlib
 import os
+import os.path
+import stat
 import sys
+import tempfile
+
+
+def datasync(fd):
+    """Flush file data of `fd` to disk."""
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        # OS X
+        fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
+
+
+def umask():
+    """Return the current umask."""
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_libc = None
+
+
+def libc():
+    """Return the C library or False if it cannot be loaded."""
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+
+def syncfs(fd):
+    """Flush the file system containing `fd` to disk.
+
+    Returns False if the platform does not support syncfs(2).
+    """
+    c = libc()
+    if not c or not hasattr(c, 'syncfs'):
+        return False
+    if c.syncfs(fd) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return True
+
+
+FICLONE = 0x40049409
+COPY_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                    errno.EOPNOTSUPP)
+
+
+def _copy_file_range(src, dst):
+    """Copy with copy_file_range(2). Returns False if unsupported."""
+    c = libc()
+    if not c or not hasattr(c, 'copy_file_range'):
+        return False
+    copy_file_range = c.copy_file_range
+    copy_file_range.restype = ctypes.c_ssize_t
+    copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                ctypes.c_void_p, ctypes.c_size_t,
+                                ctypes.c_uint]
+    copied = 0
+    while True:
+        n = copy_file_range(src, None, dst, None, 1 << 30, 0)
+        if n == 0:
+            return True
+        if n < 0:
+            err = ctypes.get_errno()
+            if not copied and err in COPY_UNSUPPORTED:
+                return False
+            raise OSError(err, os.strerror(err))
+        copied += n
+
+
+def copy_file(src, dst):
+    """Copy contents of file descriptor `src` to the empty file `dst`.
+
+    The data is shared with a reflink if the file system supports it
+    and copied in the kernel with copy_file_range(2) otherwise. Both
+    file offsets are expected to be at the beginning.
+    """
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return
+    except IOError as e:
+        if e.errno not in COPY_UNSUPPORTED:
+            raise
+    if _copy_file_range(src, dst):
+        return
+    while True:
+        data = os.read(src, 65536)
+        if not data:
+            return
+        while data:
+            data = data[os.write(dst, data):]
+
+
+class FingerprintStore(object):
+    """Remembers content hashes of files written by ConfigFile.
+
+    Each fingerprint is kept in a small file under `path` together with
+    inode, size, mtime and ctime of the file when it was written. The
+    hash is only trusted as long as these are unchanged, so that files
+    edited by other means are noticed. Failing to read or write
+    fingerprints is not an error: files are compared as usual then.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, target):
+        if isinstance(target, unicode):
+            target = target.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(target).hexdigest())
+
+    @staticmethod
+    def _key(st):
+        return '{} {} {!r} {!r}'.format(
+            st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+    def get(self, target, st):
+        """Return hash of `target` if its stat result `st` is unchanged."""
+        try:
+            with open(self._filename(target)) as f:
+                key, digest = f.read().rsplit(' ', 1)
+        except (EnvironmentError, ValueError):
+            return None
+        if key != self._key(st):
+            return None
+        return digest
+
+    def set(self, target, digest):
+        """Record `digest` as current hash of `target`."""
+        try:
+            st = os.stat(target)
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            with tempfile.NamedTemporaryFile(
+                    dir=self.path, prefix='.', delete=False) as f:
+                f.write('{} {}'.format(self._key(st), digest))
+            os.rename(f.name, self._filename(target))
+        except EnvironmentError:
+            pass
 
 
 class ConfigFile(object):
@@ -10,59 +162,169 @@ class ConfigFile(object):
 
     ConfigFile is a StringIO-like object which is able to write out it's
     contents to a file if it is different from the on-disk version.
+
+    In `atomic` mode (the default), new contents are written to a
+    temporary file which is then renamed over the target, so that
+    readers never see partially written files. Otherwise, the target is
+    locked and rewritten in place.
+
+    Hashes of written contents are kept in `fingerprints`. If the target
+    has not been touched since, unchanged contents are detected without
+    reading the target.
+
+    Diffs are cut off after `diff_lines` lines (None for no limit). Quiet
+    ConfigFiles do not compute diffs at all.
+
+    Contents exceeding `spool_size` bytes are spooled to a temporary
+    file next to the target instead of being kept in memory. In atomic
+    mode, that file is renamed into place directly. Contents are
+    compared with the existing file chunk by chunk. Files of that size
+    are not diffed, only their sizes are reported. The spool file is
+    removed if the ConfigFile is closed or dropped without committing.
     """
 
     quiet = False
+    atomic = True
+    diff_lines = 1000
+    spool_size = 4 * 1024 * 1024
+    chunk_size = 65536
+    fingerprints = FingerprintStore('/var/lib/fc-agent/configfile')
 
-    def __init__(self, filename, stdout=None, mode=0o666):
+    def __init__(self, filename, stdout=None, mode=0o666, atomic=None):
         """Create ConfigFile object.
 
         Parameters:
             filename - config file to write to
             stdout - io stream to use for diffs
+            mode - permissions for newly created files
+            atomic - override class-wide commit mode
         """
         self.filename = filename
         self.io = cStringIO.StringIO()
+        self.spooled = None
+        self.digest = None
         self.stdout = stdout
         self.changed = False
         self.mode = mode
+        if atomic is not None:
+            self.atomic = atomic
 
         if stdout is not None:
             self.stdout = stdout
         elif not self.quiet:
             self.stdout = sys.stdout
-        else:
-            self.stdout = cStringIO.StringIO()
 
     def _diff(self):
         """Dump diff between old and new to stdout."""
+        if self.stdout is None:
+            return
+        with open(self.filename) as old:
+            old_size = os.fstat(old.fileno()).st_size
+            if self.spooled or old_size > self.spool_size:
+                self.stdout.write('{}: {} bytes -> {} bytes (not diffed)\n'
+                                  .format(self.filename, old_size,
+                                          self._size()))
+                return
+            self.io.seek(0)
+            self.stdout.writelines(gocept.net.diff.unified_diff(
+                old.readlines(), self.io.readlines(),
+                self.filename + ' (old)', self.filename + ' (new)',
+                max_lines=self.diff_lines))
+
+    def write(self, data):
+        self.io.write(data)
+        if self.spooled is None and self.io.tell() > self.spool_size:
+            self._spool()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _spool(self):
+        """Move contents into a temporary file next to the target."""
+        target = self.target()
+        try:
+            f = tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(target),
+                prefix='.{}.'.format(os.path.basename(target)), delete=False)
+        except EnvironmentError:
+            # Keep contents in memory. Errors surface when committing.
+            self.spooled = False
+            return
+        f.write(self.io.getvalue())
+        self.io.close()
+        self.io = f
+        self.spooled = f.name
+
+    def _chunks(self):
+        """Generate contents piecewise."""
+        self.io.flush()
         self.io.seek(0)
-        self.stdout.writelines(difflib.unified_diff(
-            open(self.filename).readlines(), self.io.readlines(),
-            self.filename + ' (old)', self.filename + ' (new)'))
+        return iter(lambda: self.io.read(self.chunk_size), '')
+
+    def getvalue(self):
+        if not self.spooled:
+            return self.io.getvalue()
+        try:
+            return ''.join(self._chunks())
+        finally:
+            self.io.seek(0, os.SEEK_END)
+
+    def _size(self):
+        self.io.seek(0, os.SEEK_END)
+        return self.io.tell()
+
+    def _same(self, f, size):
+        """Compare contents with open file `f` of `size` bytes."""
+        if size != self._size():
+            return False
+        f.seek(0)
+        for chunk in self._chunks():
+            if f.read(len(chunk)) != chunk:
+                return False
+        return True
 
     def _writeout(self, outfile):
         """Write contents unconditionally to file."""
         outfile.seek(0)
         outfile.truncate()
-        outfile.write(self.io.getvalue())
+        for chunk in self._chunks():
+            outfile.write(chunk)
         outfile.flush()
-        if hasattr(os, 'fdatasync'):
-            os.fdatasync(outfile)
-        else:
-            # OS X
-            fcntl.fcntl(outfile, fcntl.F_FULLFSYNC)
+        datasync(outfile.fileno())
         self.changed = True
 
+    def _digest(self):
+        if self.digest is None:
+            sha1 = hashlib.sha1()
+            for chunk in self._chunks():
+                sha1.update(chunk)
+            self.digest = sha1.hexdigest()
+        return self.digest
+
+    def _unchanged(self, target, st, digest):
+        """Tell from the fingerprint whether `target` is up to date."""
+        return (self.fingerprints is not None and
+                self.fingerprints.get(target, st) == digest)
+
+    def _remember(self, target, digest):
+        if self.fingerprints is not None:
+            self.fingerprints.set(target, digest)
+
     def _update(self):
         """Update already existing file."""
+        target = self.target()
+        digest = self._digest()
         with open(self.filename, 'r+') as f:
             fcntl.flock(f, fcntl.LOCK_SH)
-            old = f.read()
-            if self.io.getvalue() != old:
+            st = os.fstat(f.fileno())
+            if self._unchanged(target, st, digest):
+                return
+            if not self._same(f, st.st_size):
                 self._diff()
                 fcntl.flock(f, fcntl.LOCK_EX)
                 self._writeout(f)
+        self._remember(target, digest)
 
     def _create(self):
         """Write contents to new file.
@@ -75,22 +337,261 @@ class ConfigFile(object):
         fcntl.flock(fd, fcntl.LOCK_EX)
         with os.fdopen(fd, 'w') as f:
             self._writeout(f)
+        self._remember(self.target(), self._digest())
+
+    def target(self):
+        """Path which is actually replaced, with symlinks resolved."""
+        return os.path.realpath(self.filename)
+
+    def _stage(self, umask, sync=False):
+        """Write contents to a temporary file if different.
+
+        The temporary file is created next to the target file with the
+        target's mode and owner. Returns its name or None if the
+        contents are unchanged. Data is synced to disk only if `sync`
+        is true.
+        """
+        target = self.target()
+        digest = self._digest()
+        try:
+            st = os.stat(target)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None
+        if st is not None:
+            if self._unchanged(target, st, digest):
+                return None
+            with open(target) as f:
+                if self._same(f, st.st_size):
+                    self._remember(target, digest)
+                    return None
+            self._diff()
+        if self.spooled:
+            f = self.io
+            tmp = self.spooled
+        else:
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(target),
+                prefix='.{}.'.format(os.path.basename(target)))
+            f = os.fdopen(fd, 'w')
+        spooled, self.spooled = self.spooled, None
+        try:
+            with f:
+                if not spooled:
+                    f.write(self.io.getvalue())
+                f.flush()
+                fd = f.fileno()
+                if sync:
+                    datasync(fd)
+                if st is None:
+                    os.fchmod(fd, self.mode & ~umask)
+                else:
+                    os.fchmod(fd, stat.S_IMODE(st.st_mode))
+                    if (st.st_uid, st.st_gid) != (os.geteuid(),
+                                                  os.getegid()):
+                        os.fchown(fd, st.st_uid, st.st_gid)
+            return tmp
+        except Exception:
+            os.unlink(tmp)
+            raise
 
     def commit(self):
         """Write contents into file if different.
 
-        No more I/O is possible on this ConfigFile instance afterwards. While
-        comparing the real file, the file is locked to prevent race conditions.
-        A diff between the new and old file contents is written to stdout.
-        Return true if the file has been changed.
+        No more I/O is possible on this ConfigFile instance afterwards. In
+        non-atomic mode, the real file is locked while comparing to prevent
+        race conditions. A diff between the new and old file contents is
+        written to stdout. Return true if the file has been changed.
         """
-        if os.path.exists(self.filename):
-            self._update()
-        else:
-            self._create()
-        self.io.close()
+        try:
+            if self.atomic:
+                self._replace()
+            elif os.path.exists(self.filename):
+                self._update()
+            else:
+                self._create()
+        finally:
+            self.close()
         return self.changed
 
+    def close(self):
+        """Discard contents which have not been written."""
+        self.io.close()
+        if self.spooled:
+            os.unlink(self.spooled)
+            self.spooled = None
+
+    def __del__(self):
+        if getattr(self, 'spooled', None):
+            self.close()
+
+    def _replace(self):
+        """Atomically replace file, keeping mode and owner."""
+        tmp = self._stage(umask(), sync=True)
+        if tmp is None:
+            return
+        try:
+            os.rename(tmp, self.target())
+        except Exception:
+            os.unlink(tmp)
+            raise
+        self.changed = True
+        self._remember(self.target(), self._digest())
+
     def __getattr__(self, name):
         """Pass everything else to underlying StringIO object."""
         return self.io.__getattribute__(name)
+
+
+class ConfigFileGroup(object):
+    """Transaction which writes several ConfigFiles at once.
+
+    Files are created with `open` and filled like single ConfigFiles.
+    `commit` writes each file whose contents differ to a temporary file,
+    flushes all of them to disk with a single barrier and finally
+    renames them into place. Existing files keep mode and owner. The
+    barrier is a syncfs(2) per file system if at least
+    `syncfs_threshold` files have changed and an fdatasync per file
+    otherwise.
+    """
+
+    syncfs_threshold = 8
+
+    def __init__(self, stdout=None):
+        self.stdout = stdout
+        self.files = []
+        self.changed = set()
+
+    def open(self, filename, mode=0o666):
+        """Return a new ConfigFile for `filename` which is part of the group.
+        """
+        f = ConfigFile(filename, self.stdout, mode)
+        self.files.append(f)
+        return f
+
+    def _sync(self, staged):
+        if len(staged) >= self.syncfs_threshold:
+            devices = {}
+            for _f, tmp in staged:
+                devices.setdefault(os.stat(tmp).st_dev, os.path.dirname(tmp))
+            synced = True
+            for directory in devices.values():
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    synced = syncfs(fd) and synced
+                finally:
+                    os.close(fd)
+            if synced:
+                return
+        for _f, tmp in staged:
+            fd = os.open(tmp, os.O_RDONLY)
+            try:
+                datasync(fd)
+            finally:
+                os.close(fd)
+
+    def commit(self):
+        """Write all changed files.
+
+        Returns the set of file names which have been changed.
+        """
+        mask = umask()
+        staged = []
+        renamed = 0
+        try:
+            for f in self.files:
+                tmp = f._stage(mask)
+                if tmp:
+                    staged.append((f, tmp))
+            self._sync(staged)
+            for f, tmp in staged:
+                os.rename(tmp, f.target())
+                renamed += 1
+                f.changed = True
+                f._remember(f.target(), f._digest())
+                self.changed.add(f.filename)
+        finally:
+            for _f, tmp in staged[renamed:]:
+                os.unlink(tmp)
+            for f in self.files:
+                f.close()
+        return self.changed
+
+
+class Changes(collections.namedtuple('Changes', 'added changed removed')):
+    """File names affected by ManagedDirectory operations.
+
+    True if anything has changed.
+    """
+
+    def __nonzero__(self):
+        return bool(self.added or self.changed or self.removed)
+
+
+class ManagedDirectory(object):
+    """Directory whose files matching `pattern` are all owned by us.
+
+    `sync` brings the directory in line with a mapping of file names to
+    contents: files are written as a ConfigFileGroup and matching files
+    not in the mapping are removed. Files not matching `pattern` are left
+    alone. The directory is read once per operation and synced to disk
+    once after removals.
+    """
+
+    def __init__(self, path, pattern='*', stdout=None, mode=0o666):
+        self.path = path
+        self.pattern = pattern
+        self.stdout = stdout
+        self.mode = mode
+
+    def existing(self):
+        """Set of file names matching `pattern`."""
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return set()
+        return set(fnmatch.filter(names, self.pattern))
+
+    def _unlink(self, names):
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if names:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def sync(self, files):
+        """Write `files` ({name: contents}) and remove all others.
+
+        Returns Changes listing added, changed and removed file names.
+        """
+        existing = self.existing()
+        if files and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        group = ConfigFileGroup(self.stdout)
+        for name, contents in sorted(files.items()):
+            group.open(os.path.join(self.path, name), self.mode).write(
+                contents)
+        written = set(os.path.basename(f) for f in group.commit())
+        removed = sorted(existing - set(files))
+        self._unlink(removed)
+        return Changes(sorted(written - existing),
+                       sorted(written & existing), removed)
+
+    def remove(self, names):
+        """Remove files `names` if present.
+
+        Returns Changes listing the removed file names.
+        """
+        removed = sorted(self.existing() & set(names))
+        self._unlink(removed)
+        return Changes([], [], removed)
@@ -93,9 +93,12 @@ class BackyConfig(object):
         Schedules may have variants which are separated by a hyphen,
         e.g. "default-full".
         """
+        listing = gocept.net.directory.IncrementalListing(
+            gocept.net.directory.Directory(), 'backy',
+            'list_virtual_machines', self.location)
         with gocept.net.directory.exceptions_screened():
-            d = gocept.net.directory.Directory()
-            vms = d.list_virtual_machines(self.location)
+            vms = listing.fetch()
+        listing.commit()
         jobs = {}
         for vm in vms:
             name = vm['name']
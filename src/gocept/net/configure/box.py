@@ -2,11 +2,23 @@ from __future__ import print_function
 from gocept.net.utils import print
 from gocept.net.configfile import ConfigFile
 from gocept.net.directory import Directory, exceptions_screened
+import errno
 import os
 import os.path as p
+import stat
 import subprocess
 
 
+def lstat(path):
+    """Return lstat result of `path` or None if it does not exist."""
+    try:
+        return os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
 class Exports(object):
 
     base = '/srv/nfs/box'
@@ -21,13 +33,27 @@ class Exports(object):
         self.create_boxes()
 
     def create_boxes(self):
+        """Create missing boxes and fix owner and mode of existing ones.
+
+        Boxes are looked up in a single listing of `base`, so only
+        existing boxes are stat'ed. Returns the number of changed boxes.
+        """
+        existing = set(os.listdir(self.base))
+        changes = 0
         for u in self.users:
             box = p.join(self.base, u['uid'])
-            if not p.exists(box):
+            st = os.lstat(box) if u['uid'] in existing else None
+            if st is None:
                 print("Creating {}".format(box))
                 os.mkdir(box)
+            elif ((st.st_uid, st.st_gid) == (u['id'], u['gid']) and
+                    stat.S_IMODE(st.st_mode) == 0o755):
+                continue
             os.chown(box, u['id'], u['gid'])
             os.chmod(box, 0o755)
+            changes += 1
+        print('{} of {} boxes changed'.format(changes, len(self.users)))
+        return changes
 
 
 class Mounts(object):
@@ -52,10 +78,16 @@ class Mounts(object):
             subprocess.check_call(['/etc/init.d/autofs', 'restart'])
 
     def ensure_symlink(self, user, box):
+        """Point `box` to the user's automounted box.
+
+        Returns True if anything has been changed.
+        """
         target = p.join('/mnt/autofs/box', user['uid'])
-        if p.islink(box) and os.readlink(box) == target:
-            return
-        if p.ismount(box):
+        st = lstat(box)
+        if st is not None and stat.S_ISLNK(st.st_mode):
+            if os.readlink(box) == target:
+                return False
+        elif st is not None and p.ismount(box):
             print('Box {} is still mounted, unmounting'.format(box))
             subprocess.check_call(['umount', box])
         if p.isdir(box):
@@ -68,11 +100,18 @@ class Mounts(object):
         if not p.exists(box):
             print('Symlinking {}'.format(box))
             os.symlink(target, box)
+        return True
 
     def ensure_symlinks(self):
+        """Returns the number of changed box symlinks."""
+        changes = 0
         for user in self.users:
             box = p.join(user['home_directory'], 'box')
-            self.ensure_symlink(user, box)
+            if self.ensure_symlink(user, box):
+                changes += 1
+        print('{} of {} box symlinks changed'.format(
+            changes, len(self.users)))
+        return changes
 
     autofs_template = (
         '{uid} -intr,soft,rsize=8192,wsize=8192 {server}:/srv/nfs/box/{uid}\n')
@@ -79,8 +79,8 @@ def volumes():
     args = p.parse_args()
     ceph = Cluster(args.conf, args.id, args.dry_run)
     with gocept.net.directory.exceptions_screened():
-        volumes = VolumeDeletions(gocept.net.directory.Directory(), ceph)
+        directory = gocept.net.directory.Directory()
+        volumes = VolumeDeletions(directory, ceph)
         volumes.ensure()
-        rpe = ResourcegroupPoolEquivalence(
-            gocept.net.directory.Directory(), ceph, args.location)
+        rpe = ResourcegroupPoolEquivalence(directory, ceph, args.location)
         rpe.ensure()
@@ -206,7 +206,7 @@ class DHCPd(object):
         """Initialize instance with location, vlan, and ipversion defaults."""
         self.location = location
         self.ipversion = ipversion
-        self.directory = Directory()
+        self.directory = Directory(streaming=True, allow_stale=True)
         self.hosts = gocept.net.dhcp.Hosts()
         self.networks = {}
 
@@ -1,7 +1,7 @@
 """Configure iptables input rules based on gocept.directory information."""
 
 from __future__ import print_function, unicode_literals
-from gocept.net.configfile import ConfigFile
+from gocept.net.configfile import ConfigFileGroup
 from gocept.net.directory import Directory, exceptions_screened
 import argparse
 import netaddr
@@ -29,33 +29,29 @@ class Iptables(object):
 
     def rg_addresses(self):
         """Query list of addresses in local vlan+location from directory."""
-        d = Directory()
+        d = Directory(allow_stale=True)
         with exceptions_screened():
             for node in d.list_addresses(self.vlan, self.location):
                 if node['rg'] == self.rg:
                     yield netaddr.IPNetwork(node['addr']).ip
 
-    def write_rg_input_rules(self, addrs):
+    def write_rg_input_rules(self, addrs, group):
         """Put one accept rule per IP address into version-specific config."""
         rulesfiles = {}
         for ipversion, filename in self.INPUT.items():
-            rulesfiles[ipversion] = ConfigFile(filename)
+            rulesfiles[ipversion] = group.open(filename)
         for addr in addrs:
             rule = '-A INPUT -i {0} -s {1} -j ACCEPT'.format(self.iface, addr)
             print(rule, file=rulesfiles[addr.version])
-        for f in rulesfiles.values():
-            f.commit()
 
-    def write_rg_output_rules(self, addrs):
+    def write_rg_output_rules(self, addrs, group):
         """Put one accept rule per IP address into version-specific config."""
         rulesfiles = {}
         for ipversion, filename in self.OUTPUT.items():
-            rulesfiles[ipversion] = ConfigFile(filename)
+            rulesfiles[ipversion] = group.open(filename)
         for addr in addrs:
             rule = '-A OUTPUT -o {0} -d {1} -j ACCEPT'.format(self.iface, addr)
             print(rule, file=rulesfiles[addr.version])
-        for f in rulesfiles.values():
-            f.commit()
 
     def feature_enabled(self):
         """Return True if iptables feature is switched on."""
@@ -72,8 +68,10 @@ class Iptables(object):
 
     def run(self):
         addrs = list(self.rg_addresses())
-        self.write_rg_input_rules(addrs)
-        self.write_rg_output_rules(addrs)
+        group = ConfigFileGroup()
+        self.write_rg_input_rules(addrs, group)
+        self.write_rg_output_rules(addrs, group)
+        group.commit()
         self.reload_iptables()
 
 
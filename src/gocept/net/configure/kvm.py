@@ -4,6 +4,7 @@ Most of this code has been migrated to Consul-triggered fc.qemu stuff.
 """
 
 import glob
+import gocept.net.configfile
 import gocept.net.directory
 from multiprocessing.pool import ThreadPool
 import os
@@ -30,13 +31,6 @@ class VM(object):
         self.name = name
         self.cfg = self.configfile.format(root=VM.root, name=name)
 
-    def unlink(self):
-        """Idempotent config delete action"""
-        if os.path.exists(self.cfg):
-            if VERBOSE:
-                print('cleaning {}'.format(self.cfg))
-            os.unlink(self.cfg)
-
     def ensure(self):
         """Check single VM"""
         cmd = ['fc-qemu', 'ensure', self.name]
@@ -51,9 +45,15 @@ def delete_configs():
     directory = gocept.net.directory.Directory()
     with gocept.net.directory.exceptions_screened():
         deletions = directory.deletions('vm')
-    for name, node in deletions.items():
-        if 'hard' in node['stages']:
-            VM(name).unlink()
+    configs = gocept.net.configfile.ManagedDirectory(
+        os.path.dirname(VM.configfile.format(root=VM.root, name='')),
+        '*.cfg')
+    removed = configs.remove('{}.cfg'.format(name)
+                             for name, node in deletions.items()
+                             if 'hard' in node['stages'])
+    if VERBOSE:
+        for cfg in removed.removed:
+            print('cleaning {}'.format(os.path.join(configs.path, cfg)))
 
 
 def ensure_vms():
@@ -2,10 +2,12 @@
 # users with the "stats" permission. Users with the keyword "nonagios" in their
 # description field are excluded from mails but still able to log in.
 
+import gocept.net.configfile
 import gocept.net.directory
 import gocept.net.ldaptools
 import hashlib
 import ldap
+import ldap.dn
 import logging
 import os
 import os.path
@@ -38,23 +40,29 @@ define contactgroup {
 """
 
 
+PERMISSIONS = ('stats', 'wheel')
+
+
 class NagiosContacts(object):
 
     prefix = ''
+    page_size = 500
 
     def __init__(self):
         self.directory = gocept.net.directory.Directory()
         self.needs_restart = False
         self.contacts_seen = {}
+        self._permissions = None
 
     def _init_ldap(self):
         self.ldapconf = gocept.net.ldaptools.load_ldapconf('/etc/ldap.conf')
-        self.server = ldap.initialize('ldap://%s/' % self.ldapconf['host'])
-        self.server.protocol_version = ldap.VERSION3
-        self.server.simple_bind_s(
-            self.ldapconf['binddn'], self.ldapconf['bindpw'])
+        server = ldap.initialize('ldap://%s/' % self.ldapconf['host'])
+        server.protocol_version = ldap.VERSION3
+        server.simple_bind_s(self.ldapconf['binddn'], self.ldapconf['bindpw'])
+        self.server = gocept.net.ldaptools.CountingServer(server)
         self.groups = list(self.search(
-            'ou=Group', '(objectClass=posixGroup)'))
+            'ou=Group', '(objectClass=posixGroup)',
+            attrlist=['cn', 'description', 'memberUid']))
         if len(self.groups) <= 1:
             raise RuntimeError(
                 'safety check: not enough data returned by LDAP query: %r' %
@@ -62,9 +70,11 @@ class NagiosContacts(object):
 
     def search(self, base, *args, **kw):
         base = '%s,%s' % (base, self.ldapconf['base'])
+        kw.setdefault('page_size', self.page_size)
         return gocept.net.ldaptools.search(self.server, base, *args, **kw)
 
     def finish(self):
+        logger.debug('%d LDAP search requests', self.server.searches)
         self.server.unbind()
         if self.needs_restart:
             os.system('/etc/init.d/nagios reload > /dev/null')
@@ -107,18 +117,40 @@ class NagiosContacts(object):
                   if group['cn'] == ['admins']][0]
         return admins['memberUid']
 
-    def _permission_map(self, permission):
-        permission_map = {}
+    def _permission_maps(self):
+        """Groups per user for each of PERMISSIONS.
+
+        All grants are fetched with a single subtree search and assigned
+        to the group they are stored under.
+        """
+        if self._permissions is not None:
+            return self._permissions
+        base = 'ou=Group,%s' % self.ldapconf['base']
+        groups = {}
         for group in self.groups:
             group_id = group['cn'][0]
-            for grant in self.search(
-                    'cn=%s,ou=Group' % group_id,
-                    '(&(permission=%s)(objectClass=permissionGrant))' %
-                    permission):
-                for user in grant['uid']:
-                    permission_map.setdefault(user, set())
-                    permission_map[user].add(group_id)
-        return permission_map
+            groups[gocept.net.ldaptools.normalize_dn('cn=%s,%s' % (
+                ldap.dn.escape_dn_chars(group_id), base))] = group_id
+        self._permissions = dict((p, {}) for p in PERMISSIONS)
+        grants = self.search(
+            'ou=Group', '(&(objectClass=permissionGrant)(|%s))' % ''.join(
+                '(permission=%s)' % p for p in PERMISSIONS),
+            scope=ldap.SCOPE_SUBTREE, attrlist=['permission', 'uid'],
+            dn=True)
+        for dn, grant in grants:
+            group_id = groups.get(gocept.net.ldaptools.parent_dn(dn))
+            if group_id is None:
+                continue
+            for permission in grant.get('permission', []):
+                if permission not in self._permissions:
+                    continue
+                permission_map = self._permissions[permission]
+                for user in grant.get('uid', []):
+                    permission_map.setdefault(user, set()).add(group_id)
+        return self._permissions
+
+    def _permission_map(self, permission):
+        return self._permission_maps()[permission]
 
     def stats_permission(self):
         """Dict that lists groups for which each user has stats permissions"""
@@ -130,7 +162,8 @@ class NagiosContacts(object):
 
     def users(self):
         return self.search(
-            'ou=People', '(&(cn=*)(objectClass=organizationalPerson))')
+            'ou=People', '(&(cn=*)(objectClass=organizationalPerson))',
+            attrlist=['uid', 'cn', 'mail', 'description'])
 
     def contacts(self):
         """List all users as contacts"""
@@ -185,19 +218,18 @@ def nodes():
         d = gocept.net.directory.Directory()
         deletions = d.deletions('vm')
     reload_nagios = False
+    hosts = gocept.net.configfile.ManagedDirectory(
+        NagiosContacts.prefix + '/etc/nagios/hosts', '*.cfg')
+    hostcfgs = []
     for name, node in deletions.items():
         if 'soft' in node['stages']:
+            hostcfgs.append('{}.cfg'.format(name))
             try:
                 hostdir = (NagiosContacts.prefix +
                            '/etc/nagios/hosts/{}'.format(name))
                 if os.path.exists(hostdir):
                     reload_nagios = True
                     shutil.rmtree(hostdir)
-                hostcfg = (NagiosContacts.prefix +
-                           '/etc/nagios/hosts/{}.cfg'.format(name))
-                if os.path.exists(hostcfg):
-                    reload_nagios = True
-                    os.unlink(hostcfg)
             except Exception, e:
                 logger.exception(e)
         if 'purge' in node['stages']:
@@ -208,5 +240,10 @@ def nodes():
                     shutil.rmtree(perfdata)
             except Exception, e:
                 logger.exception(e)
+    try:
+        if hosts.remove(hostcfgs):
+            reload_nagios = True
+    except Exception, e:
+        logger.exception(e)
     if reload_nagios:
         os.system('/etc/init.d/nagios reload > /dev/null')
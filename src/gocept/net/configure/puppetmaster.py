@@ -23,15 +23,21 @@ class Puppetmaster(object):
         self.nodes = []
 
     def autosign(self):
+        listing = gocept.net.directory.IncrementalListing(
+            self.directory, 'autosign-{}-{}'.format(
+                self.location, self.suffix), 'list_nodes')
         with gocept.net.directory.exceptions_screened():
-            self.nodes = ['{0}.{1}'.format(node['name'], self.suffix)
-                          for node in self.directory.list_nodes()
-                          if node['parameters']['location'] == self.location]
+            nodes = listing.fetch()
+        self.nodes = ['{0}.{1}'.format(node['name'], self.suffix)
+                      for node in nodes
+                      if node['parameters']['location'] == self.location]
         self.nodes.sort()
+        # Always compare, so that manual changes get reverted.
         conffile = gocept.net.configfile.ConfigFile(self.autosign_conf)
         conffile.write('\n'.join(self.nodes))
         conffile.write('\n')
         conffile.commit()
+        listing.commit()
 
     def delete_nodes(self):
         with gocept.net.directory.exceptions_screened():
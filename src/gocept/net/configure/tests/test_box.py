@@ -0,0 +1,47 @@
+from ..box import Exports, Mounts
+import mock
+import os
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def directory(monkeypatch):
+    monkeypatch.setattr('gocept.net.configure.box.Directory', mock.Mock())
+
+
+@pytest.fixture
+def users(tmpdir):
+    uid, gid = os.getuid(), os.getgid()
+    return [{'uid': name, 'id': uid, 'gid': gid, 'class': 'human',
+             'home_directory': str(tmpdir.mkdir('home').mkdir(name))
+             if name == 'alice' else str(tmpdir / 'home' / name)}
+            for name in ['alice', 'bob']]
+
+
+def test_create_boxes_fixes_only_differing_boxes(
+        tmpdir, monkeypatch, users):
+    base = tmpdir.mkdir('box')
+    base.mkdir('alice').chmod(0o755)
+    base.mkdir('other').chmod(0o700)
+    monkeypatch.setattr(Exports, 'base', str(base))
+    e = Exports()
+    e.users = users
+    assert 1 == e.create_boxes()
+    assert 0o755 == base.join('bob').stat().mode & 0o777
+    assert 0o700 == base.join('other').stat().mode & 0o777
+    base.join('alice').chmod(0o700)
+    assert 1 == e.create_boxes()
+    assert 0o755 == base.join('alice').stat().mode & 0o777
+    assert 0 == e.create_boxes()
+
+
+def test_ensure_symlinks_counts_changes(tmpdir, users):
+    tmpdir.join('home').mkdir('bob')
+    os.symlink('/mnt/autofs/box/alice', users[0]['home_directory'] + '/box')
+    os.symlink('/wrong', users[1]['home_directory'] + '/box')
+    m = Mounts('server', 'rg')
+    m.users = users
+    assert 1 == m.ensure_symlinks()
+    assert '/mnt/autofs/box/bob' == os.readlink(
+        users[1]['home_directory'] + '/box')
+    assert 0 == m.ensure_symlinks()
@@ -113,3 +113,25 @@ def test_delete_nodes(empty_config, tmpdir, capsys, monkeypatch, directory):
     assert not os.path.exists(str(tmpdir / '/etc/nagios/hosts/node04/asdf'))
     assert not os.path.exists(str(tmpdir / '/etc/nagios/hosts/node04.cfg'))
     assert not os.path.exists(str(tmpdir / '/var/nagios/perfdata/node04'))
+
+
+def test_permission_maps_use_single_query(directory):
+    contacts = NagiosContacts()
+    contacts.ldapconf = {'base': 'dc=example,dc=com'}
+    contacts.groups = [{'cn': ['rg1']}, {'cn': ['rg2']}]
+    queries = []
+
+    def search(base, filter, **kw):
+        queries.append((base, filter, kw))
+        return iter([
+            ('cn=g1,cn=rg1,ou=Group,dc=example,dc=com',
+             {'permission': ['stats'], 'uid': ['alice', 'bob']}),
+            ('cn=g2,cn=RG2,ou=Group,dc=example,dc=com',
+             {'permission': ['stats', 'wheel'], 'uid': ['alice']}),
+            ('cn=g3,cn=other,ou=Group,dc=example,dc=com',
+             {'permission': ['stats'], 'uid': ['eve']})])
+    contacts.search = search
+    assert {'alice': set(['rg1', 'rg2']),
+            'bob': set(['rg1'])} == contacts.stats_permission()
+    assert {'alice': set(['rg2'])} == contacts.wheel_permission()
+    assert 1 == len(queries)
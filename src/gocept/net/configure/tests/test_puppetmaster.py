@@ -44,6 +44,21 @@ class PuppetmasterConfigurationTest(unittest.TestCase):
         self.assertMultiLineEqual('vm01.example.com\nvm02.example.com\n',
                                   open(self.autosign_conf).read())
 
+    def test_autosign_conf_is_restored_if_nodes_are_unchanged(self):
+        self.fake_directory().list_nodes_changed_since.side_effect = (
+            gocept.net.directory.xmlrpclib.Fault(-32601, 'not supported'))
+        self.fake_directory().list_nodes.return_value = [
+            {'name': 'vm01', 'parameters': {'location': 'here'}}]
+        master = gocept.net.configure.puppetmaster.Puppetmaster(
+            'here', 'example.com')
+        master.autosign_conf = self.autosign_conf
+        master.autosign()
+        with open(self.autosign_conf, 'w') as f:
+            f.write('*\n')
+        master.autosign()
+        self.assertEqual('vm01.example.com\n',
+                         open(self.autosign_conf).read())
+
     def test_autosign_race_condition_unknown_not_signed(self):
         master = gocept.net.configure.puppetmaster.Puppetmaster(
             'here', 'example.com')
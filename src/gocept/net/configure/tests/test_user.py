@@ -1,10 +1,11 @@
 from __future__ import print_function
 
-from ..users import UserConfig
+from ..users import Skeleton, UserConfig
 import gocept.net.utils
 import datetime
 import os
 import pytest
+import stat
 
 
 @pytest.fixture
@@ -127,6 +128,8 @@ Applying changes for /etc/shadow:
 """
     assert err == ""
 
+    # The home directory setup of bob is skipped. Only the owner of .ssh
+    # is fixed, as the chown above was not real.
     users[0]['name'] = 'Bob'
     configuration = UserConfig('testrg', prefix=str(empty_dbs))
     configuration.apply()
@@ -172,3 +175,74 @@ bob:fdsajkfbdsa:9797:0:::::
 alice:fdsajkfbdsa:9797:0:::::\
 """)
     UserConfig('testrg', prefix=str(tmpdir))
+
+
+def test_changed_users_are_provisioned_again(
+        empty_dbs, capsys, monkeypatch, directory):
+    users = [{'uid': 'bob',
+              'id': 1003,
+              'gid': 1000,
+              'name': 'Bob',
+              'password': '',
+              'ssh_pubkey': [],
+              'permissions': {'testrg': []},
+              'login_shell': '/bin/bash',
+              'home_directory': '/home/bob'}]
+
+    def load(self):
+        self.users = users
+        self.permissions = []
+        self.admins_group = {'gid': 2003, 'name': 'admins'}
+        self.admins_permission = {'name': 'admins'}
+        self.rg_info = {'gid': 2043}
+    monkeypatch.setattr(UserConfig, '_load', load)
+    monkeypatch.setattr(os, 'chown', lambda *args: None)
+
+    def provision():
+        configuration = UserConfig('testrg', prefix=str(empty_dbs))
+        configuration.ensure_permission_groups()
+        configuration.ensure_rg_unix_group()
+        configuration.ensure_users()
+        configuration.finish()
+        capsys.readouterr()
+        return open(str(empty_dbs / 'home/bob/.ssh/authorized_keys')).read()
+
+    assert 'ssh-ed25519' not in provision()
+    users[0]['ssh_pubkey'] = ['ssh-ed25519 AAAA bob@example.com']
+    assert 'ssh-ed25519 AAAA' in provision()
+    # Manual changes are noticed, too.
+    with open(str(empty_dbs / 'home/bob/.ssh/authorized_keys'), 'w') as f:
+        f.write('edited\n')
+    assert 'ssh-ed25519 AAAA' in provision()
+    # Skipped users still get the mode of their .ssh directory fixed.
+    ssh = str(empty_dbs / 'home/bob/.ssh')
+    os.chmod(ssh, 0o755)
+    provision()
+    assert 0o711 == stat.S_IMODE(os.stat(ssh).st_mode)
+
+
+def test_skeleton_copy(tmpdir, monkeypatch):
+    skel = tmpdir.mkdir('skel')
+    skel.join('.profile').write('small')
+    skel.mkdir('.config').join('large').write('x' * 100)
+    skel.join('.config').chmod(0o750)
+    skel.join('.config', 'large').chmod(0o600)
+    skel.join('link').mksymlinkto('.profile')
+    owners = []
+    monkeypatch.setattr(os, 'chown', lambda p, u, g: owners.append(p))
+    monkeypatch.setattr(os, 'lchown', lambda p, u, g: owners.append(p))
+    monkeypatch.setattr(os, 'fchown', lambda fd, u, g: owners.append(fd))
+    monkeypatch.setattr(Skeleton, 'cache_size', 10)
+
+    skeleton = Skeleton(str(skel))
+    # Contents are read once, large files are copied from the skeleton.
+    skel.join('.profile').write('changed')
+    skeleton.copy(str(tmpdir / 'home/bob'), 1000, 100)
+
+    home = tmpdir / 'home/bob'
+    assert 'small' == home.join('.profile').read()
+    assert 'x' * 100 == home.join('.config', 'large').read()
+    assert 0o750 == home.join('.config').stat().mode & 0o777
+    assert 0o600 == home.join('.config', 'large').stat().mode & 0o777
+    assert '.profile' == home.join('link').readlink()
+    assert 5 == len(owners)
@@ -1,13 +1,17 @@
 """Manage users, home directories and store public SSH keys."""
 
 from __future__ import unicode_literals, print_function
-from gocept.net.directory import Directory, exceptions_screened
+from gocept.net.directory import Batch, Directory, exceptions_screened
+from multiprocessing.pool import ThreadPool
 import gocept.net.configfile
 import gocept.net.passwd
+import hashlib
+import json
 import os
 import os.path
-import shutil
+import stat
 import sys
+import threading
 
 
 def sanitize_password(hash=''):
@@ -26,11 +30,101 @@ def sanitize_password(hash=''):
         return 'x'
 
 
+def _digest(user):
+    """Hash of the user attributes affecting home directory setup."""
+    return hashlib.sha1(json.dumps([
+        user['uid'], user['id'], user['gid'], user['home_directory'],
+        user['login_shell'], user['ssh_pubkey']])).hexdigest()
+
+
+class Skeleton(object):
+    """Manifest of a skeleton directory like /etc/skel.
+
+    The skeleton is scanned once. `copy` creates a home directory from
+    it in a single pass, setting ownership while creating each entry.
+    Files up to `cache_size` bytes are kept in memory, larger files are
+    copied with gocept.net.configfile.copy_file.
+    """
+
+    cache_size = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self.mode = stat.S_IMODE(os.stat(path).st_mode)
+        self.entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                self._scan(os.path.join(root, name))
+
+    def _scan(self, path):
+        relpath = os.path.relpath(path, self.path)
+        st = os.lstat(path)
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISLNK(st.st_mode):
+            self.entries.append(('link', relpath, os.readlink(path)))
+        elif stat.S_ISDIR(st.st_mode):
+            self.entries.append(('dir', relpath, mode))
+        elif stat.S_ISREG(st.st_mode):
+            contents = None
+            if st.st_size <= self.cache_size:
+                with open(path, 'rb') as f:
+                    contents = f.read()
+            self.entries.append(('file', relpath, (mode, contents)))
+
+    def _copy_file(self, relpath, target, mode, contents, uid, gid):
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            if contents is None:
+                src = os.open(os.path.join(self.path, relpath), os.O_RDONLY)
+                try:
+                    gocept.net.configfile.copy_file(src, fd)
+                finally:
+                    os.close(src)
+            else:
+                while contents:
+                    contents = contents[os.write(fd, contents):]
+            os.fchown(fd, uid, gid)
+            os.fchmod(fd, mode)
+        finally:
+            os.close(fd)
+
+    def copy(self, target, uid, gid):
+        """Create `target` with the skeleton's contents owned by uid/gid."""
+        os.makedirs(target)
+        os.chmod(target, self.mode)
+        os.chown(target, uid, gid)
+        for kind, relpath, data in self.entries:
+            path = os.path.join(target, relpath)
+            if kind == 'dir':
+                os.mkdir(path, 0o700)
+                os.chown(path, uid, gid)
+                os.chmod(path, data)
+            elif kind == 'file':
+                self._copy_file(relpath, path, data[0], data[1], uid, gid)
+            else:
+                os.symlink(data, path)
+                os.lchown(path, uid, gid)
+
+
 class UserConfig(object):
+    """Local users, groups and home directories of a resource group.
+
+    Home directory and SSH setup is skipped for users whose attributes
+    and authorized_keys file are unchanged since the last run, as
+    recorded in `fingerprints`. Other users are set up using up to
+    `threads` threads.
+    """
+
+    fingerprints = gocept.net.configfile.FingerprintStore(
+        '/var/lib/fc-agent/users')
+    threads = 8
 
     def __init__(self, resource_group, prefix=''):
         self.prefix = prefix  # test support
         self.resource_group = resource_group
+        self._skeleton = None
+        self._skeleton_lock = threading.Lock()
 
         self.etcgrp = gocept.net.passwd.Group(self._map('/etc/group'))
         self.etcpasswd = gocept.net.passwd.Passwd(self._map('/etc/passwd'))
@@ -39,27 +133,28 @@ class UserConfig(object):
         self._load()
 
     def _load(self):
-        directory = Directory()
+        batch = Batch(Directory(), read_only=True)
+        batch.list_users(self.resource_group)
+        batch.list_permissions()
+        batch.lookup_resourcegroup('admins')
+        batch.lookup_resourcegroup(self.resource_group)
         with exceptions_screened():
-            self.users = directory.list_users(self.resource_group)
-            self.permissions = directory.list_permissions()
-            self.admins_group = directory.lookup_resourcegroup('admins')
-            self.admins_permission = {'description': 'Administrators',
-                                      'id': self.admins_group['gid'],
-                                      'name': self.admins_group['name']}
-            self.rg_info = directory.lookup_resourcegroup(self.resource_group)
+            (self.users, self.permissions,
+             self.admins_group, self.rg_info) = batch()
+        self.admins_permission = {'description': 'Administrators',
+                                  'id': self.admins_group['gid'],
+                                  'name': self.admins_group['name']}
 
     def _map(self, path):
         return self.prefix + path
 
     def finish(self):
         for db in [self.etcgrp, self.etcpasswd, self.etcshadow]:
-            diff = db.diff()
-            if diff:
+            changed, diff = db.save()
+            if changed:
                 print('Applying changes for %s:' %
                       db.path.replace(self.prefix, ''), file=sys.stdout)
                 print(b''.join(diff), file=sys.stdout)
-            db.save()
             db.close()
 
     def ensure_permission_groups(self):
@@ -78,22 +173,41 @@ class UserConfig(object):
         rg_grp.gid = str(self.rg_info['gid'])
 
     def ensure_users(self):
+        changed = []
         for user in self.users:
             self.ensure_user(user)
-            self.ensure_homedir(user)
-            self.ensure_ssh(user)
-            self.ensure_permissions(user)
+            if self.provisioned(user):
+                self.ensure_ssh_dir(user)
+            else:
+                changed.append(user)
+        if changed:
+            pool = ThreadPool(min(self.threads, len(changed)))
+            try:
+                pool.map(self.ensure_home, changed)
+            finally:
+                pool.close()
+                pool.join()
+        authorized_keys = gocept.net.configfile.ConfigFileGroup()
+        owners = {}
+        for user in changed:
+            owners[self.stage_authorized_keys(user, authorized_keys)] = user
+        for filename in sorted(authorized_keys.commit()):
+            user = owners[filename]
+            os.chown(filename, user['id'], user['gid'])
+            os.chmod(filename, 0o640)
+        for user in changed:
+            self.fingerprints.set(self._authorized_keys(user), _digest(user))
         # Delete unknown users in directory range.
-        known_uids = [
-            user['uid']
-            for user in self.users]
+        known_uids = set(user['uid'] for user in self.users)
+        deleted = []
         for user in self.etcpasswd.records[:]:
             if 1000 <= int(user.uid) <= 64999:
                 if user.login_name not in known_uids:
                     self.etcpasswd.records.remove(user)
                     user_shadow = self.etcshadow.get(user.login_name)
                     self.etcshadow.records.remove(user_shadow)
-                    self.ensure_permissions_for_user_name(user.login_name, [])
+                    deleted.append(user.login_name)
+        self.ensure_permissions(deleted)
 
     def ensure_user(self, user):
         # XXX re-implement user deletion based on deletion timestamp
@@ -120,6 +234,24 @@ class UserConfig(object):
         user_shadow = self.etcshadow.get(user_pwd.login_name, create=True)
         user_shadow.password = sanitize_password(user['password'])
 
+    def _authorized_keys(self, user):
+        return self._map(os.path.join(
+            user['home_directory'], '.ssh', 'authorized_keys'))
+
+    def provisioned(self, user):
+        """Tell whether home directory and SSH setup are up to date."""
+        path = self._authorized_keys(user)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return self.fingerprints.get(path, st) == _digest(user)
+
+    def ensure_home(self, user):
+        """Set up home and .ssh directories."""
+        self.ensure_homedir(user)
+        self.ensure_ssh_dir(user)
+
     def ensure_homedir(self, user):
         """Manage home directory contents."""
         homedir = self._map(user['home_directory'])
@@ -127,48 +259,69 @@ class UserConfig(object):
             return
         print('Creating home directory {0[home_directory]} for {0[uid]}'.
               format(user), file=sys.stdout)
-        shutil.copytree(self._map('/etc/skel'), homedir, symlinks=True)
-        for root, dirs, files in os.walk(homedir, followlinks=False):
-            os.chown(root, user['id'], user['gid'])
-            for file in files:
-                os.chown(os.path.join(root, file), user['id'], user['gid'])
+        self.skeleton().copy(homedir, user['id'], user['gid'])
 
-    def ensure_ssh(self, user):
+    def skeleton(self):
+        """Return Skeleton of /etc/skel, scanned once per run."""
+        with self._skeleton_lock:
+            if self._skeleton is None:
+                self._skeleton = Skeleton(self._map('/etc/skel'))
+        return self._skeleton
+
+    def ensure_ssh_dir(self, user):
+        """Create .ssh directory and fix its mode and owner if needed."""
         ssh = self._map(os.path.join(user['home_directory'], '.ssh'))
-        if not os.path.exists(ssh):
+        try:
+            st = os.stat(ssh)
+        except OSError:
             print('(Re-)creating .ssh directory {}'.
                   format(ssh.replace(self.prefix, '')), file=sys.stdout)
             # Don't rely on skel for creating the .ssh directory
             os.mkdir(ssh)
+        else:
+            if (stat.S_IMODE(st.st_mode) == 0o711 and
+                    (st.st_uid, st.st_gid) == (user['id'], user['gid'])):
+                return
         os.chmod(ssh, 0o711)
         os.chown(ssh, user['id'], user['gid'])
-        authorized_keys = os.path.join(ssh, 'authorized_keys')
-        output = gocept.net.configfile.ConfigFile(authorized_keys)
+
+    def stage_authorized_keys(self, user, group):
+        """Stage authorized_keys in `group` and return its path."""
+        authorized_keys = self._authorized_keys(user)
+        output = group.open(authorized_keys)
         print("# Managed by localconfig-users: do not edit this file "
               "directly. It will be overwritten!", file=output)
         for key in user['ssh_pubkey']:
             print(key, file=output)
-        changed = output.commit()
-        if changed:
-            os.chown(authorized_keys, user['id'], user['gid'])
-            os.chmod(authorized_keys, 0o640)
-
-    def ensure_permissions(self, user):
-        granted_permissions = user['permissions'][self.resource_group]
-        self.ensure_permissions_for_user_name(user['uid'], granted_permissions)
-
-    def ensure_permissions_for_user_name(self, user_name, granted_permissions):
-        for permission in self.permissions + [self.admins_permission]:
-            group = self.etcgrp.get(permission['name'])
-            members = set(group.members.split(','))
-            if (permission['name'] in granted_permissions and
-                    user_name not in members):
-                members.add(user_name)
-            if (permission['name'] not in granted_permissions and
-                    user_name in members):
-                members.remove(user_name)
-            group.members = ''
-            group.add_members(*members)
+        return authorized_keys
+
+    def permission_members(self):
+        """Map each permission group to the directory users granted it."""
+        members = dict((permission['name'], set()) for permission in
+                       self.permissions + [self.admins_permission])
+        for user in self.users:
+            for name in user['permissions'][self.resource_group]:
+                if name in members:
+                    members[name].add(user['uid'])
+        return members
+
+    def ensure_permissions(self, deleted=()):
+        """Update members of all permission groups in a single pass.
+
+        Directory users and `deleted` user names are added to or removed
+        from each group according to their permissions. Other members
+        are kept.
+        """
+        managed = set(user['uid'] for user in self.users)
+        managed.update(deleted)
+        if not managed:
+            return
+        for name, granted in self.permission_members().items():
+            group = self.etcgrp.get(name)
+            members = set(group.members.split(',')) - set([''])
+            updated = (members - managed) | granted
+            if updated != members:
+                group.members = ','.join(sorted(updated))
 
     def apply(self):
         self.ensure_permission_groups()
@@ -1,5 +1,5 @@
 from __future__ import unicode_literals, print_function
-from gocept.net.configfile import ConfigFile
+from gocept.net.configfile import ConfigFileGroup
 from gocept.net.directory import Directory, exceptions_screened
 from netaddr import ip
 import argparse
@@ -61,16 +61,21 @@ class Zone(object):
 
     def save(self):
         """Updates zone file on disk. Returns True if anything has changed."""
+        group = ConfigFileGroup()
+        self.stage(group)
+        return bool(group.commit())
+
+    def stage(self, group):
+        """Adds zone file with new serial to `group` if it has changed."""
         old_serial = self.parse_serial()
         if old_serial:
             with open(self.fullpath()) as old:
                 if old.read() == self.render(old_serial):
-                    return False
+                    return
         new_serial = max([int(gocept.net.utils.now().strftime('%Y%m%d00')),
                           (old_serial or 0) + 1])
-        f = ConfigFile(self.fullpath())
+        f = group.open(self.fullpath())
         f.write(self.render(new_serial))
-        return f.commit()
 
     r_serial = re.compile(r'^\s*(\d+) ; serial$', re.M)
 
@@ -271,11 +276,14 @@ class Zones(object):
 
         Returns True if anything has changed.
         """
-        changed = False
+        group = ConfigFileGroup()
+        self.stage_zones(group)
+        return bool(group.commit())
+
+    def stage_zones(self, group):
         for zone in ([self.external_forward, self.internal_forward] +
                      self.reverse_zones.values()):
-            changed |= zone.save()
-        return changed
+            zone.stage(group)
 
     def all_internal_zones(self):
         """Collects all Zone objects for the internal view."""
@@ -291,9 +299,13 @@ class Zones(object):
 
         Returns True is anything has changed.
         """
-        changed = False
+        group = ConfigFileGroup()
+        self.stage_bind_config(group)
+        return bool(group.commit())
+
+    def stage_bind_config(self, group):
         for ztype in ('internal', 'external'):
-            f = ConfigFile(self.config[ztype]['zonelist'])
+            f = group.open(self.config[ztype]['zonelist'])
             f.write('// Managed by localconfig-zones: do not edit this file!')
             for zone in getattr(self, 'all_{}_zones'.format(ztype))():
                 f.write("""
@@ -302,12 +314,16 @@ zone "{origin}" IN {{
     file "{filename}";
 }};
 """.format(origin=zone.origin, filename=zone.fullpath()))
-            changed |= f.commit()
-        return changed
 
     def update(self):
-        # don't use "or" instead of "|" -> this would short-circuit
-        return self.update_zones() | self.update_bind_config()
+        """Updates zone files and BIND zones lists in one transaction.
+
+        Returns True if anything has changed.
+        """
+        group = ConfigFileGroup()
+        self.stage_zones(group)
+        self.stage_bind_config(group)
+        return bool(group.commit())
 
 
 def join_dn(*labels):
@@ -368,29 +384,43 @@ class NodeAddr(object):
                 zones.add_reverse(self.addr, self.reverse or default_name)
 
 
+def node_addrs(node):
+    """Generate NodeAddr objects for all addresses of a directory node."""
+    shortname = node['name']
+    location = node['parameters']['location']
+    production = node['parameters']['production']
+
+    # Choose the VLAN for the canonical name: SRV is preferable, but some
+    # devices only have MGMT and then we use that.
+    canonical_vlan = None
+    vlans = set(node['parameters']['interfaces'])
+    for v in ['srv', 'mgm']:
+        if v in vlans:
+            canonical_vlan = v
+            break
+
+    # sort everything to keep stable ordering
+    for vlan, params in sorted(node['parameters']['interfaces'].items()):
+        for addresses in sorted(params['networks'].values()):
+            for addr in sorted(addresses):
+                reverse = node['parameters']['reverses'].get(addr)
+                yield NodeAddr(shortname, vlan, location,
+                               ip.IPAddress(addr), production, reverse,
+                               canonical=(vlan == canonical_vlan))
+
+
 def walk(directory):
-    for node in sorted(directory.list_nodes()):
-        shortname = node['name']
-        location = node['parameters']['location']
-        production = node['parameters']['production']
-        
-        # Choose the VLAN for the canonical name: SRV is preferable, but some
-        # devices only have MGMT and then we use that.
-        canonical_vlan = None
-        vlans = set(node['parameters']['interfaces'])
-        for v in ['srv', 'mgm']:
-            if v in vlans:
-                canonical_vlan = v
-                break
-
-        # sort everything to keep stable ordering
-        for vlan, params in sorted(node['parameters']['interfaces'].items()):
-            for addresses in sorted(params['networks'].values()):
-                for addr in sorted(addresses):
-                    reverse = node['parameters']['reverses'].get(addr)
-                    yield NodeAddr(shortname, vlan, location,
-                                   ip.IPAddress(addr), production, reverse,
-                                   canonical=(vlan == canonical_vlan))
+    """Generate NodeAddr objects for all nodes, ordered by node name.
+
+    Nodes are processed one at a time while the directory response is
+    being received. Only the resulting NodeAddr objects are kept.
+    """
+    nodes = [(node['name'], list(node_addrs(node)))
+             for node in directory.list_nodes()]
+    nodes.sort(key=lambda n: n[0])
+    for _name, addrs in nodes:
+        for node_addr in addrs:
+            yield node_addr
 
 
 def update():
@@ -400,7 +430,7 @@ def update():
     args = a.parse_args()
     config = configobj.ConfigObj(args.config)
     zones = Zones(config)
-    directory = Directory()
+    directory = Directory(streaming=True, allow_stale=True)
     with exceptions_screened():
         for node_addr in walk(directory):
             node_addr.inject_records(zones)
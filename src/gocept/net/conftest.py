@@ -1,5 +1,7 @@
 import pytest
 import mock
+import gocept.net.configfile
+import gocept.net.configure.users
 import gocept.net.directory
 
 
@@ -8,3 +10,29 @@ def directory(monkeypatch):
     directory = mock.Mock()
     monkeypatch.setattr(gocept.net.directory, 'Directory', directory)
     return directory
+
+
+@pytest.fixture(autouse=True)
+def sync_dir(tmpdir, monkeypatch):
+    """Keep local copies of directory listings out of the system."""
+    monkeypatch.setenv('DIRECTORY_SYNC_DIR', str(tmpdir / 'directory-sync'))
+
+
+@pytest.fixture(autouse=True)
+def fingerprints(tmpdir, monkeypatch):
+    """Keep ConfigFile fingerprints out of the system."""
+    store = gocept.net.configfile.FingerprintStore(
+        str(tmpdir / 'fingerprints'))
+    monkeypatch.setattr(gocept.net.configfile.ConfigFile, 'fingerprints',
+                        store)
+    return store
+
+
+@pytest.fixture(autouse=True)
+def user_fingerprints(tmpdir, monkeypatch):
+    """Keep localconfig-users fingerprints out of the system."""
+    store = gocept.net.configfile.FingerprintStore(
+        str(tmpdir / 'user-fingerprints'))
+    monkeypatch.setattr(gocept.net.configure.users.UserConfig,
+                        'fingerprints', store)
+    return store
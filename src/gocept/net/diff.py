@@ -0,0 +1,210 @@
+"""Unified diffs with bounded run time and output size.
+
+difflib's SequenceMatcher is quadratic in the worst case, which is too
+slow for generated files with hundreds of thousands of lines. This
+module aligns lines with a patience diff instead: common prefix and
+suffix are skipped, lines occurring exactly once in both versions
+serve as anchors and only small regions between anchors are handed to
+difflib. Larger regions without anchors are reported as replaced
+wholesale.
+"""
+
+import bisect
+import difflib
+
+BUDGET = 1000000
+
+
+def _unique_common(a, alo, ahi, b, blo, bhi):
+    """Pairs of indexes of lines which occur once in a and b, ordered by a.
+    """
+    counts = {}
+    for i in range(alo, ahi):
+        line = a[i]
+        counts[line] = (counts[line][0] + 1, i) if line in counts else (1, i)
+    matches = {}
+    for j in range(blo, bhi):
+        line = b[j]
+        if line not in counts or counts[line][0] != 1:
+            continue
+        if line in matches:
+            matches[line] = None
+        else:
+            matches[line] = j
+    return sorted((counts[line][1], j)
+                  for line, j in matches.items() if j is not None)
+
+
+def _patience(pairs):
+    """Longest subsequence of `pairs` which is increasing in b as well."""
+    tails = []
+    tail_indexes = []
+    back = []
+    for k, (_i, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        back.append(tail_indexes[pos - 1] if pos else None)
+        if pos == len(tails):
+            tails.append(j)
+            tail_indexes.append(k)
+        else:
+            tails[pos] = j
+            tail_indexes[pos] = k
+    result = []
+    k = tail_indexes[-1] if tail_indexes else None
+    while k is not None:
+        result.append(pairs[k])
+        k = back[k]
+    result.reverse()
+    return result
+
+
+def _region(a, alo, ahi, b, blo, bhi, budget):
+    """Opcodes for a region without unique common lines."""
+    if alo == ahi and blo == bhi:
+        return []
+    if alo == ahi:
+        return [('insert', alo, ahi, blo, bhi)]
+    if blo == bhi:
+        return [('delete', alo, ahi, blo, bhi)]
+    if (ahi - alo) * (bhi - blo) > budget:
+        return [('replace', alo, ahi, blo, bhi)]
+    matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], False)
+    return [(tag, i1 + alo, i2 + alo, j1 + blo, j2 + blo)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes()]
+
+
+def opcodes(a, b, budget=BUDGET):
+    """Return difflib-style opcodes transforming list `a` into `b`.
+
+    Regions without anchors are compared with difflib only if the
+    product of their lengths does not exceed `budget`.
+    """
+    result = []
+    # Work items are either regions to compare or finished opcodes. They
+    # are pushed in reverse order so that output is produced in order.
+    stack = [('region', 0, len(a), 0, len(b))]
+    while stack:
+        item = stack.pop()
+        if item[0] != 'region':
+            result.append(item)
+            continue
+        _, alo, ahi, blo, bhi = item
+        if alo == ahi or blo == bhi:
+            result.extend(_region(a, alo, ahi, b, blo, bhi, budget))
+            continue
+        prefix = alo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        start = ('equal', prefix, alo, blo - (alo - prefix), blo)
+        suffix = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        end = ('equal', ahi, suffix, bhi, bhi + (suffix - ahi))
+        anchors = _patience(_unique_common(a, alo, ahi, b, blo, bhi))
+        items = [start]
+        if anchors:
+            i, j = alo, blo
+            for ai, bj in anchors:
+                items.append(('region', i, ai, j, bj))
+                items.append(('equal', ai, ai + 1, bj, bj + 1))
+                i, j = ai + 1, bj + 1
+            items.append(('region', i, ahi, j, bhi))
+        else:
+            items.extend(_region(a, alo, ahi, b, blo, bhi, budget))
+        items.append(end)
+        stack.extend(reversed(items))
+    return _merge(result)
+
+
+def _merge(codes):
+    """Join adjacent opcodes of the same kind."""
+    merged = []
+    for tag, i1, i2, j1, j2 in codes:
+        if i1 == i2 and j1 == j2:
+            continue
+        if merged and merged[-1][0] == tag:
+            merged[-1] = (tag, merged[-1][1], i2, merged[-1][3], j2)
+        elif (merged and {tag, merged[-1][0]} <= {'insert', 'delete',
+                                                   'replace'}):
+            merged[-1] = ('replace', merged[-1][1], i2, merged[-1][3], j2)
+        else:
+            merged.append((tag, i1, i2, j1, j2))
+    return merged
+
+
+def _grouped(codes, n):
+    """Group opcodes into hunks with `n` lines of context.
+
+    Same as difflib.SequenceMatcher.get_grouped_opcodes.
+    """
+    codes = list(codes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _range(start, stop):
+    """Format line range like difflib.unified_diff."""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+
+def unified_diff(a, b, fromfile='', tofile='', n=3, max_lines=None,
+                 budget=BUDGET):
+    """Generate unified diff lines like difflib.unified_diff.
+
+    At most `max_lines` lines are generated. If the diff is longer, it
+    is cut off with a summary of the number of added and removed lines.
+    """
+    codes = opcodes(a, b, budget)
+    changes = [c for c in codes if c[0] != 'equal']
+    if not changes:
+        return
+    added = sum(j2 - j1 for _tag, _i1, _i2, j1, j2 in changes)
+    removed = sum(i2 - i1 for _tag, i1, i2, _j1, _j2 in changes)
+    count = 0
+    for line in _unified(a, b, codes, fromfile, tofile, n):
+        if max_lines is not None and count >= max_lines:
+            yield ('[diff truncated after {} lines: {} lines added, {} '
+                   'lines removed in total]\n'.format(count, added, removed))
+            return
+        count += 1
+        yield line
+
+
+def _unified(a, b, codes, fromfile, tofile, n):
+    yield '--- {}\n'.format(fromfile)
+    yield '+++ {}\n'.format(tofile)
+    for group in _grouped(codes, n):
+        first, last = group[0], group[-1]
+        yield '@@ -{} +{} @@\n'.format(_range(first[1], last[2]),
+                                       _range(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            for line in a[i1:i2]:
+                yield '-' + line
+            for line in b[j1:j2]:
+                yield '+' + line
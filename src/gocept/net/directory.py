@@ -1,32 +1,857 @@
+from multiprocessing.pool import ThreadPool
+import atexit
+import gocept.net.xmlrpc
+import hashlib
+import json
+import logging
 import os
 import re
 import socket
+import sys
+import tempfile
+import threading
+import time
+import types
 import urlparse
+import xml.parsers.expat
 import xmlrpclib
 
+_log = logging.getLogger(__name__)
 
-def directory_server():
+DEFAULTS = '/etc/local/configure/defaults'
+SECRET = '/etc/directory.secret'
+CACHE_DIR = '/var/cache/fc-agent/directory'
+CACHE_TTL = 60
+CHUNK_SIZE = 65536
+TEXTFILE_DIR = '/var/lib/node_exporter/textfile_collector'
+SYNC_DIR = '/var/lib/fc-agent/directory'
+DELTA_PROBE_INTERVAL = 86400
+STALE_WAIT = 5
+REFRESH_TIMEOUT = 30
+
+LIST_HEADER = ("<?xml version='1.0'?>\n<methodResponse>\n<params>\n"
+               "<param>\n<value><array><data>\n")
+LIST_FOOTER = ("</data></array></value>\n</param>\n</params>\n"
+               "</methodResponse>\n")
+
+
+def localconfig_setting(key, default=None):
+    """Look up `key` in the environment or in the localconfig defaults.
+
+    Returns `default` if the setting is present in neither place.
+    """
     try:
-        return os.environ['DIRECTORY_SERVER']
+        return os.environ[key]
     except KeyError:
         pass
-    for line in open('/etc/local/configure/defaults'):
-        if not line.startswith('DIRECTORY_SERVER='):
-            continue
-        url = line.split('=')[1]
-        return url.strip(' \n"')
-    raise RuntimeError('cannot find DIRECTORY_SERVER in localconfig defaults')
+    try:
+        with open(DEFAULTS) as f:
+            for line in f:
+                if line.startswith(key + '='):
+                    return line.split('=', 1)[1].strip(' \n"')
+    except IOError:
+        pass
+    return default
+
+
+def directory_server():
+    url = localconfig_setting('DIRECTORY_SERVER')
+    if url is None:
+        raise RuntimeError(
+            'cannot find DIRECTORY_SERVER in localconfig defaults')
+    return url
+
+
+def Directory(cache_ttl=None, streaming=False, allow_stale=False):
+    """Create a directory proxy.
+
+    All proxies of a process share keep-alive connections to the
+    directory (see `gocept.net.xmlrpc.PersistentTransport`). With
+    `streaming` enabled, calls which return lists return iterators
+    instead which decode one element at a time.
+
+    Read-only calls are served from the on-disk `DirectoryCache` if it
+    contains responses younger than `cache_ttl` seconds. The TTL
+    defaults to the DIRECTORY_CACHE_TTL localconfig setting. A TTL of
+    0 disables caching.
+
+    Scripts which only generate configuration may pass `allow_stale`.
+    If the DIRECTORY_STALE_TTL localconfig setting is given, expired
+    cache entries up to that age are then returned right away and
+    refreshed in the background (see `CachedDirectory`). A refresh gets
+    DIRECTORY_STALE_WAIT seconds (default 5) to deliver fresh data before
+    the stale entry is used and at most DIRECTORY_REFRESH_TIMEOUT seconds
+    (default 30) to read the response. Never allow stale data for scripts
+    which delete things based on the directory.
+
+    Calls which go out to the directory are recorded in `metrics`.
+    """
+    proxy = _proxy(streaming)
+    metrics.write_at_exit()
+    if cache_ttl is None:
+        cache_ttl = int(localconfig_setting('DIRECTORY_CACHE_TTL', CACHE_TTL))
+    if not cache_ttl:
+        return proxy
+    cache = DirectoryCache(
+        localconfig_setting('DIRECTORY_CACHE_DIR', CACHE_DIR), cache_ttl)
+    stale_ttl = 0
+    if allow_stale:
+        stale_ttl = int(localconfig_setting('DIRECTORY_STALE_TTL', 0))
+    if not stale_ttl:
+        return CachedDirectory(proxy, cache, streaming)
+    return CachedDirectory(
+        proxy, cache, streaming, stale_ttl,
+        stale_wait=float(localconfig_setting('DIRECTORY_STALE_WAIT',
+                                             STALE_WAIT)),
+        refresh_proxy=_proxy(read_timeout=int(localconfig_setting(
+            'DIRECTORY_REFRESH_TIMEOUT', REFRESH_TIMEOUT))))
 
 
-def Directory():
+def _proxy(streaming=False, read_timeout=None):
+    """Instrumented XML-RPC proxy for the directory."""
     user = socket.gethostname()
-    password = open('/etc/directory.secret').read().strip()
-    url = directory_server()
-    parts = urlparse.urlsplit(url)
-    if not socket.getdefaulttimeout():
-        socket.setdefaulttimeout(300)
-    return xmlrpclib.ServerProxy('%s://%s:%s@%s%s' % (
-        parts.scheme, user, password, parts.netloc, parts.path))
+    with open(localconfig_setting('DIRECTORY_SECRET', SECRET)) as f:
+        password = f.read().strip()
+    parts = urlparse.urlsplit(directory_server())
+    transport = gocept.net.xmlrpc.PersistentTransport(
+        parts.scheme, read_timeout=read_timeout, streaming=streaming)
+    return InstrumentedDirectory(xmlrpclib.ServerProxy(
+        '%s://%s:%s@%s%s' % (
+            parts.scheme, user, password, parts.netloc, parts.path),
+        transport=transport), transport)
+
+
+class DirectoryMetrics(object):
+    """Per-method statistics of directory calls.
+
+    For each method, the number of calls and failed calls, the total
+    latency in seconds, the number of response bytes received and the
+    number of decoded objects (list elements or struct members) are
+    summed up. `stale` counts responses served from expired cache
+    entries. Statistics cover a single run of a script and are exported
+    as gauges.
+    """
+
+    fields = ('calls', 'errors', 'seconds', 'bytes', 'objects', 'stale')
+
+    def __init__(self):
+        self.methods = {}
+        self.lock = threading.Lock()
+        self.registered = False
+
+    def _method(self, method):
+        return self.methods.setdefault(
+            method, dict((field, 0) for field in self.fields))
+
+    def record(self, method, seconds, received, objects, error=False):
+        with self.lock:
+            m = self._method(method)
+            m['calls'] += 1
+            m['errors'] += int(error)
+            m['seconds'] += seconds
+            m['bytes'] += received
+            m['objects'] += objects
+
+    def record_stale(self, method):
+        with self.lock:
+            self._method(method)['stale'] += 1
+
+    def textfile(self, script):
+        """Render statistics as Prometheus gauges in text format."""
+        out = []
+        for field, help in [
+                ('calls', 'Number of directory calls.'),
+                ('errors', 'Number of failed directory calls.'),
+                ('seconds', 'Time spent in directory calls.'),
+                ('bytes', 'Response bytes received from the directory.'),
+                ('objects', 'Objects decoded from directory responses.'),
+                ('stale', 'Responses served from expired cache entries.')]:
+            name = 'fc_agent_directory_{}'.format(field)
+            out.append('# HELP {} {}'.format(name, help))
+            out.append('# TYPE {} gauge'.format(name))
+            for method, m in sorted(self.methods.items()):
+                out.append('{}{{script="{}",method="{}"}} {}'.format(
+                    name, script, method, m[field]))
+        return '\n'.join(out) + '\n'
+
+    def write(self, script=None):
+        """Write statistics to the configured destinations.
+
+        The Prometheus textfile goes into DIRECTORY_METRICS_DIR if that
+        directory exists. If DIRECTORY_METRICS_LOG is set, a JSON line is
+        appended to that file as well.
+        """
+        if not self.methods:
+            return
+        script = script or os.path.basename(sys.argv[0])
+        textfile_dir = localconfig_setting(
+            'DIRECTORY_METRICS_DIR', TEXTFILE_DIR)
+        log = localconfig_setting('DIRECTORY_METRICS_LOG')
+        try:
+            if os.path.isdir(textfile_dir):
+                with tempfile.NamedTemporaryFile(
+                        dir=textfile_dir, prefix='.fc-agent', delete=False
+                        ) as f:
+                    f.write(self.textfile(script))
+                os.chmod(f.name, 0o644)
+                os.rename(f.name, os.path.join(
+                    textfile_dir, 'fc-agent-directory-{}.prom'.format(script)))
+            if log:
+                with open(log, 'a') as f:
+                    f.write(json.dumps({'script': script,
+                                        'time': time.time(),
+                                        'methods': self.methods},
+                                       sort_keys=True) + '\n')
+        except EnvironmentError as e:
+            _log.warning('cannot write directory metrics: %s', e)
+
+    def write_at_exit(self):
+        if not self.registered:
+            atexit.register(self.write)
+            self.registered = True
+
+
+metrics = DirectoryMetrics()
+
+
+class DirectoryCache(object):
+    """Persistent on-disk store for directory responses.
+
+    Responses are kept per method and arguments as XML-RPC method
+    responses, i.e. exactly in the form the directory sends them.
+    Entries older than `ttl` seconds count as missing. New entries are
+    written to a temporary file and renamed into place so that
+    concurrently running scripts never see partial entries. The cache
+    directory is private to its owner as responses may contain password
+    hashes.
+    """
+
+    def __init__(self, path=CACHE_DIR, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _filename(self, method, args):
+        key = hashlib.sha1(xmlrpclib.dumps(args, allow_none=True))
+        return os.path.join(self.path, '{}-{}.xml'.format(
+            method, key.hexdigest()))
+
+    def get(self, method, args, streaming=False, ttl=None):
+        """Return cached response for `method(*args)`.
+
+        With `streaming` enabled, lists are returned as iterators which
+        read the cache entry piecewise. `ttl` overrides the maximum age
+        of the entry. Raises KeyError if there is no valid entry.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        filename = self._filename(method, args)
+        try:
+            f = open(filename)
+        except EnvironmentError as e:
+            _log.debug('cannot read cache entry %s: %s', filename, e)
+            raise KeyError(method, args)
+        try:
+            if time.time() - os.fstat(f.fileno()).st_mtime > ttl:
+                raise KeyError('expired')
+            if streaming:
+                return gocept.net.xmlrpc.iterparse(
+                    iter(lambda: f.read(CHUNK_SIZE), ''),
+                    lambda success: f.close())
+            return xmlrpclib.loads(f.read())[0][0]
+        except (KeyError, EnvironmentError, xmlrpclib.Error,
+                xml.parsers.expat.ExpatError, IndexError) as e:
+            f.close()
+            _log.debug('cannot read cache entry %s: %s', filename, e)
+            raise KeyError(method, args)
+        finally:
+            if not streaming:
+                f.close()
+
+    def set(self, method, args, result):
+        """Store `result` as response for `method(*args)`.
+
+        Failing to update the cache is not an error: the next caller
+        simply has to ask the directory again.
+        """
+        f = self._write(self._open(method), xmlrpclib.dumps(
+            (result,), methodresponse=True, allow_none=True))
+        self._commit(f, method, args)
+
+    def tee(self, method, args, values):
+        """Generate `values` while storing them as list response."""
+        f = self._write(self._open(method), LIST_HEADER)
+        try:
+            for value in values:
+                f = self._write(f, _dump_value(value))
+                yield value
+        except BaseException:
+            self._abort(f)
+            raise
+        f = self._write(f, LIST_FOOTER)
+        self._commit(f, method, args)
+
+    def _open(self, method):
+        """Open a temporary file for a new entry or return None."""
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            return tempfile.NamedTemporaryFile(
+                dir=self.path, prefix='.' + method, delete=False)
+        except EnvironmentError as e:
+            _log.warning('cannot update directory cache: %s', e)
+
+    def _write(self, f, data):
+        """Write `data` to `f`. Returns None if `f` is unusable."""
+        if f is None:
+            return
+        try:
+            f.write(data)
+            return f
+        except EnvironmentError as e:
+            _log.warning('cannot update directory cache: %s', e)
+            self._abort(f)
+
+    def _commit(self, f, method, args):
+        if f is None:
+            return
+        try:
+            f.close()
+            os.rename(f.name, self._filename(method, args))
+        except EnvironmentError as e:
+            _log.warning('cannot update directory cache: %s', e)
+            self._abort(f)
+
+    def _abort(self, f):
+        if f is None:
+            return
+        f.close()
+        try:
+            os.unlink(f.name)
+        except EnvironmentError:
+            pass
+
+
+def _dump_value(value):
+    """Marshal a single value as <value> element."""
+    params = xmlrpclib.dumps((value,), allow_none=True)
+    return params[len('<params>\n<param>\n'):-len('</param>\n</params>\n')]
+
+
+class CachedDirectory(object):
+    """Directory proxy which answers read-only calls from a cache.
+
+    Calls not listed in `cacheable` are passed to the directory
+    unconditionally.
+
+    With a `stale_ttl`, expired entries not older than `stale_ttl`
+    seconds are refreshed in a background thread through
+    `refresh_proxy`. Fresh data is returned if it arrives within
+    `stale_wait` seconds, otherwise the expired entry is served. Pending
+    refreshes do not keep the process from exiting; the next run tries
+    again. Methods which returned stale data are listed in `stale`,
+    logged and counted in `metrics`.
+    """
+
+    cacheable = frozenset([
+        'deletions',
+        'list_nodes',
+        'list_nodes_addresses',
+        'list_permissions',
+        'list_users',
+        'list_virtual_machines',
+        'lookup_networks_details',
+        'lookup_resourcegroup',
+    ])
+
+    def __init__(self, proxy, cache, streaming=False, stale_ttl=0,
+                 metrics=metrics, stale_wait=0, refresh_proxy=None):
+        self._proxy = proxy
+        self._cache = cache
+        self._streaming = streaming
+        self._stale_ttl = stale_ttl
+        self._stale_wait = stale_wait
+        self._refresh_proxy = refresh_proxy or proxy
+        self._metrics = metrics
+        self._refreshing = set()
+        self.stale = set()
+
+    def __getattr__(self, name):
+        method = getattr(self._proxy, name)
+        if name not in self.cacheable:
+            return method
+
+        def cached(*args):
+            try:
+                return self._cache.get(name, args, self._streaming)
+            except KeyError:
+                pass
+            try:
+                result = self._get_stale(name, args, self._streaming)
+            except KeyError:
+                pass
+            else:
+                if self._revalidate([(name, args)]):
+                    try:
+                        fresh = self._cache.get(name, args, self._streaming)
+                    except KeyError:
+                        pass
+                    else:
+                        if isinstance(result, types.GeneratorType):
+                            result.close()
+                        return fresh
+                self._served_stale(name, args)
+                return result
+            result = method(*args)
+            if isinstance(result, types.GeneratorType):
+                return self._cache.tee(name, args, result)
+            self._cache.set(name, args, result)
+            return result
+        return cached
+
+    def multicall(self, calls, read_only=False, faults=False):
+        """Like `multicall`, but only sends calls not found in the cache."""
+        results = {}
+        missing = []
+        stale = []
+        for i, (name, args) in enumerate(calls):
+            if name in self.cacheable:
+                try:
+                    results[i] = self._cache.get(name, args)
+                    continue
+                except KeyError:
+                    pass
+                try:
+                    results[i] = self._get_stale(name, args)
+                    stale.append(i)
+                    continue
+                except KeyError:
+                    pass
+            missing.append(i)
+        refreshed = self._revalidate([calls[i] for i in stale])
+        for i in stale:
+            name, args = calls[i]
+            if refreshed:
+                try:
+                    results[i] = self._cache.get(name, args)
+                    continue
+                except KeyError:
+                    pass
+            self._served_stale(name, args)
+        fetched = multicall(
+            self._proxy, [calls[i] for i in missing], read_only, faults)
+        for i, result in zip(missing, fetched):
+            name, args = calls[i]
+            if (name in self.cacheable and
+                    not isinstance(result, xmlrpclib.Fault)):
+                self._cache.set(name, args, result)
+            results[i] = result
+        return [results[i] for i in range(len(calls))]
+
+    def _get_stale(self, name, args, streaming=False):
+        """Return an expired entry if stale data is acceptable."""
+        if not self._stale_ttl:
+            raise KeyError(name, args)
+        return self._cache.get(name, args, streaming, self._stale_ttl)
+
+    def _served_stale(self, name, args):
+        _log.warning('directory: serving stale response for %s%r',
+                     name, args)
+        self.stale.add(name)
+        self._metrics.record_stale(name)
+
+    def _revalidate(self, calls):
+        """Refresh cache entries for `calls` in a daemon thread.
+
+        Waits up to `stale_wait` seconds for the refresh to finish and
+        tells whether it did.
+        """
+        calls = [c for c in calls if c not in self._refreshing]
+        if not calls:
+            return False
+        self._refreshing.update(calls)
+        t = threading.Thread(target=self._refresh, args=(calls,))
+        t.daemon = True
+        t.start()
+        if not self._stale_wait:
+            return False
+        t.join(self._stale_wait)
+        return not t.is_alive()
+
+    def _refresh(self, calls):
+        try:
+            if len(calls) == 1:
+                name, args = calls[0]
+                results = [getattr(self._refresh_proxy, name)(*args)]
+            else:
+                results = multicall(
+                    self._refresh_proxy, calls, read_only=True)
+            for (name, args), result in zip(calls, results):
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                self._cache.set(name, args, result)
+        except Exception as e:
+            _log.warning('directory: cannot refresh stale responses: %s', e)
+        finally:
+            self._refreshing.difference_update(calls)
+
+
+def multicall(proxy, calls, read_only=False, faults=False):
+    """Perform several directory calls in a single request.
+
+    `calls` is a list of (method name, args) pairs. Returns the list of
+    results in the same order. Faults of individual calls are raised as
+    xmlrpclib.Fault, just like the first failing call would when called
+    one after another. Note that the server performs all calls of the
+    request nevertheless. Pass `faults` to get xmlrpclib.Fault instances
+    in place of the failed calls' results instead, so that callers can
+    tell which calls took effect.
+
+    Servers which do not support system.multicall get the calls one
+    after another. Only if all calls are `read_only`, they are sent
+    concurrently instead (see `gather`).
+    """
+    if not calls:
+        return []
+    try:
+        results = proxy.system.multicall(
+            [{'methodName': name, 'params': args} for name, args in calls])
+    except xmlrpclib.Fault as e:
+        _log.debug('system.multicall failed (%s), falling back to '
+                   'single calls', e)
+        if faults:
+            return [_call_or_fault(proxy, name, args)
+                    for name, args in calls]
+        if read_only:
+            return gather(proxy, calls)
+        return [getattr(proxy, name)(*args) for name, args in calls]
+    if faults:
+        return [entry[0] if isinstance(entry, list) else
+                xmlrpclib.Fault(entry['faultCode'], entry['faultString'])
+                for entry in results]
+    return list(xmlrpclib.MultiCallIterator(list(results)))
+
+
+def _call_or_fault(proxy, name, args):
+    try:
+        return getattr(proxy, name)(*args)
+    except xmlrpclib.Fault as e:
+        return e
+
+
+class ConcurrentDirectory(object):
+    """Directory proxy which performs calls in a bounded thread pool.
+
+    Calls return a `multiprocessing.pool.AsyncResult` right away. Its
+    `get` method waits for the result or raises the call's exception.
+    The default number of threads matches the number of connections
+    kept open by the connection pool. Use as context manager to shut
+    down the threads afterwards::
+
+        with ConcurrentDirectory(directory) as d:
+            users = d.list_users('test')
+            permissions = d.list_permissions()
+            users, permissions = users.get(), permissions.get()
+    """
+
+    def __init__(self, directory, size=None):
+        self._directory = directory
+        self._pool = ThreadPool(size or gocept.net.xmlrpc.pool.size)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self._directory, name)
+
+        def submit(*args):
+            return self._pool.apply_async(method, args)
+        return submit
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.terminate()
+        return False
+
+
+def gather(directory, calls):
+    """Perform independent directory calls concurrently.
+
+    `calls` is a list of (method name, args) pairs. Returns the list of
+    results in the same order or raises the exception of the first
+    failed call.
+    """
+    if not calls:
+        return []
+    with ConcurrentDirectory(directory, min(
+            len(calls), gocept.net.xmlrpc.pool.size)) as d:
+        results = [getattr(d, name)(*args) for name, args in calls]
+        return [r.get() for r in results]
+
+
+class Batch(object):
+    """Collect directory calls to send them with a single request.
+
+    Calls on the batch are recorded. Calling the batch itself performs
+    all recorded calls and returns their results in order::
+
+        batch = Batch(directory, read_only=True)
+        batch.list_users('test')
+        batch.list_permissions()
+        users, permissions = batch()
+
+    Batches which only query the directory should be marked `read_only`
+    to allow sending them concurrently if multicall is not available.
+    With `faults`, failed calls return their xmlrpclib.Fault instead of
+    raising it (see `multicall`).
+    """
+
+    def __init__(self, directory, read_only=False, faults=False):
+        self.directory = directory
+        self.read_only = read_only
+        self.faults = faults
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def record(*args):
+            self.calls.append((name, args))
+        return record
+
+    def __call__(self):
+        calls, self.calls = self.calls, []
+        if isinstance(self.directory, CachedDirectory):
+            return self.directory.multicall(
+                calls, self.read_only, self.faults)
+        return multicall(self.directory, calls, self.read_only, self.faults)
+
+
+class IncrementalListing(object):
+    """Local copy of a directory listing which is updated incrementally.
+
+    The copy is kept per `consumer` in DIRECTORY_SYNC_DIR together with
+    the directory's watermark. `fetch` asks the directory only for
+    records changed since the watermark by calling `<method>_changed_since`
+    with the listing's arguments and the watermark. The directory is
+    expected to return a struct with the new `watermark`, a list of
+    `changed` records and a list of `deleted` names. An empty watermark
+    asks for all records. Records are identified by their name.
+
+    If the directory does not support this, the complete listing is
+    fetched instead. This is remembered in the local copy, so the
+    directory is asked for changes again only after
+    DIRECTORY_DELTA_PROBE_INTERVAL seconds (default: one day). In both
+    cases, `changed` tells whether the listing differs from the one seen
+    when `commit` was called last. Consumers call `commit` once they
+    have successfully processed the listing::
+
+        listing = IncrementalListing(directory, 'autosign', 'list_nodes')
+        nodes = listing.fetch()
+        if listing.changed:
+            ...
+        listing.commit()
+    """
+
+    def __init__(self, directory, consumer, method, *args):
+        self.directory = directory
+        self.method = method
+        self.args = list(args)
+        self.filename = os.path.join(
+            localconfig_setting('DIRECTORY_SYNC_DIR', SYNC_DIR),
+            '{}-{}.xml'.format(consumer, method))
+        self.watermark = ''
+        self.records = None
+        self.changed = True
+        self.unsupported = None
+        self._digest = None
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                state = xmlrpclib.loads(f.read())[0][0]
+        except (EnvironmentError, xmlrpclib.Error,
+                xml.parsers.expat.ExpatError, IndexError) as e:
+            _log.debug('no local copy in %s: %s', self.filename, e)
+            return {}
+        if state.get('args') != self.args:
+            return {}
+        return state
+
+    def _delta(self, watermark):
+        """Return changes since `watermark` or None if unsupported."""
+        try:
+            delta = getattr(self.directory, self.method + '_changed_since')(
+                *(self.args + [watermark]))
+        except xmlrpclib.Fault as e:
+            _log.debug('%s: delta fetch not supported (%s)', self.method, e)
+            return
+        if not (isinstance(delta, dict) and 'watermark' in delta and
+                'changed' in delta):
+            _log.debug('%s: unexpected delta response', self.method)
+            return
+        return delta
+
+    def _probe(self, state):
+        """Tell whether to ask the directory for changes."""
+        unsupported = state.get('unsupported')
+        interval = int(localconfig_setting(
+            'DIRECTORY_DELTA_PROBE_INTERVAL', DELTA_PROBE_INTERVAL))
+        if unsupported and time.time() - unsupported < interval:
+            self.unsupported = unsupported
+            return False
+        return True
+
+    def fetch(self):
+        """Return the current listing sorted by name."""
+        state = self._load()
+        watermark = state.get('watermark', '')
+        records = {}
+        if watermark:
+            records = dict((r['name'], r) for r in state['records'])
+        delta = None
+        if self._probe(state):
+            delta = self._delta(watermark)
+            if delta is None:
+                self.unsupported = int(time.time())
+        if delta is None:
+            records = dict((r['name'], r) for r in getattr(
+                self.directory, self.method)(*self.args))
+            self.watermark = ''
+        else:
+            for record in delta['changed']:
+                records[record['name']] = record
+            for name in delta.get('deleted', []):
+                records.pop(name, None)
+            self.watermark = delta['watermark']
+        self.records = [records[name] for name in sorted(records)]
+        self._digest = None
+        self.changed = self.digest() != state.get('digest')
+        if not self.changed:
+            _log.debug('%s: nothing changed', self.method)
+        return self.records
+
+    def digest(self):
+        """Hash of the listing, computed one record at a time."""
+        if self._digest is None:
+            h = hashlib.sha1()
+            for record in self.records:
+                h.update(json.dumps(record, sort_keys=True))
+                h.update('\n')
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def commit(self):
+        """Store the listing as processed. Failing to do so is no error.
+
+        Records are kept only if they can be updated incrementally.
+        """
+        state = {'args': self.args, 'watermark': self.watermark,
+                 'digest': self.digest(),
+                 'records': self.records if self.watermark else []}
+        if self.unsupported:
+            state['unsupported'] = self.unsupported
+        path = os.path.dirname(self.filename)
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path, 0o700)
+            with tempfile.NamedTemporaryFile(
+                    dir=path, prefix='.sync', delete=False) as f:
+                f.write(xmlrpclib.dumps(
+                    (state,), methodresponse=True, allow_none=True))
+            os.rename(f.name, self.filename)
+        except EnvironmentError as e:
+            _log.warning('cannot store local copy of %s: %s',
+                         self.method, e)
+
+
+def _count_objects(result):
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return 1
+
+
+class InstrumentedDirectory(object):
+    """Directory proxy which records calls in `DirectoryMetrics`.
+
+    Received bytes are taken from the per-request counter of the
+    `transport`. Streamed results are accounted for when the iterator is
+    exhausted or closed. Each call of a successful `system.multicall`
+    batch is recorded under its own method name, with latency and bytes
+    of the request shared evenly among them.
+    """
+
+    def __init__(self, proxy, transport, metrics=metrics, prefix=''):
+        self._proxy = proxy
+        self._transport = transport
+        self._metrics = metrics
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return InstrumentedDirectory(
+            getattr(self._proxy, name), self._transport, self._metrics,
+            self._prefix + name + '.')
+
+    def __call__(self, *args):
+        method = self._prefix.rstrip('.')
+        start = time.time()
+        # The transport replaces this counter when the request goes out.
+        self._transport.current.received = gocept.net.xmlrpc.RequestCounter()
+        try:
+            result = self._proxy(*args)
+            received = self._transport.current.received
+            if method == 'system.multicall':
+                result = list(result)
+        except Exception:
+            self._record(method, args, time.time() - start,
+                         self._transport.current.received.wire, None)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return self._stream(method, result, start, received)
+        self._record(method, args, time.time() - start, received.wire,
+                     result)
+        return result
+
+    def _record(self, method, args, seconds, received, result):
+        """Record a call. A `result` of None denotes a failed call."""
+        if result is None:
+            self._metrics.record(method, seconds, received, 0, error=True)
+            return
+        if method != 'system.multicall':
+            self._metrics.record(method, seconds, received,
+                                 _count_objects(result))
+            return
+        calls = args[0]
+        for call, entry in zip(calls, result):
+            if isinstance(entry, list):
+                objects, error = _count_objects(entry[0]), False
+            else:
+                objects, error = 0, True
+            self._metrics.record(
+                call['methodName'], seconds / len(calls),
+                received // len(calls), objects, error=error)
+
+    def _stream(self, method, values, start, received):
+        objects = 0
+        success = False
+        try:
+            for value in values:
+                objects += 1
+                yield value
+            success = True
+        finally:
+            self._metrics.record(method, time.time() - start, received.wire,
+                                 objects, error=not success)
 
 
 def exceptions_screened():
@@ -0,0 +1,301 @@
+"""Local stand-in for the directory to test generators at scale.
+
+The fake directory serves responses from a fixture file. Fixtures are
+either recorded from the real directory or generated synthetically::
+
+    fake-directory generate -n 10000 -l dev dev.xml
+    fake-directory record -l dev -r test dev.xml
+    fake-directory serve -p 8080 dev.xml
+
+Point localconfig scripts to the fake by setting DIRECTORY_SERVER to
+http://localhost:8080/ and DIRECTORY_SECRET to any readable file.
+"""
+
+import SimpleXMLRPCServer
+import SocketServer
+import argparse
+import gocept.net.directory
+import logging
+import os
+import random
+import tempfile
+import xmlrpclib
+
+_log = logging.getLogger(__name__)
+
+
+class Fixture(object):
+    """Recorded responses per method and parameters."""
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls(xmlrpclib.loads(f.read())[0][0])
+
+    def save(self, filename):
+        """Write fixture atomically to `filename`."""
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(os.path.abspath(filename)),
+                prefix='.fixture', delete=False) as f:
+            f.write(xmlrpclib.dumps(
+                (self.responses,), methodresponse=True, allow_none=True))
+        os.rename(f.name, filename)
+
+    def add(self, method, params, result):
+        entries = self.responses.setdefault(method, [])
+        for entry in entries:
+            if entry[0] == list(params):
+                entry[1] = result
+                return
+        entries.append([list(params), result])
+
+    def lookup(self, method, params):
+        """Return recorded result. Raises KeyError if there is none."""
+        for entry_params, result in self.responses.get(method, []):
+            if entry_params == list(params):
+                return result
+        raise KeyError(method, params)
+
+
+class FakeDirectory(object):
+    """XML-RPC instance which answers calls from a `Fixture`.
+
+    Calls which modify directory state are accepted and logged in
+    `calls`, unless the fixture contains a response for them.
+    """
+
+    def __init__(self, fixture):
+        self.fixture = fixture
+        self.calls = []
+
+    def _dispatch(self, method, params):
+        self.calls.append((method, params))
+        try:
+            return self.fixture.lookup(method, params)
+        except KeyError:
+            pass
+        try:
+            default = getattr(self, 'default_' + method)
+        except AttributeError:
+            raise xmlrpclib.Fault(
+                -32601, 'no recorded response for {}{!r}'.format(
+                    method, tuple(params)))
+        return default(*params)
+
+    def default_schedule_maintenance(self, requests):
+        return dict((uuid, {'time': None}) for uuid in requests)
+
+    def default_postpone_maintenance(self, requests):
+        return None
+
+    def default_end_maintenance(self, requests):
+        return None
+
+    def default_mark_node_service_status(self, node, status):
+        return None
+
+
+class Server(SocketServer.ThreadingMixIn,
+             SimpleXMLRPCServer.SimpleXMLRPCServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """Keep-alive request handler which accepts any path."""
+
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ()
+
+
+def server(fixture, host='localhost', port=0):
+    """Create server for `fixture`. Call `serve_forever` to run it."""
+    s = Server((host, port), RequestHandler, logRequests=False,
+               allow_none=True)
+    s.register_instance(FakeDirectory(fixture))
+    s.register_multicall_functions()
+    return s
+
+
+class Recorder(object):
+    """Directory proxy wrapper which records all responses in a fixture."""
+
+    def __init__(self, proxy, fixture):
+        self._proxy = proxy
+        self._fixture = fixture
+
+    def __getattr__(self, name):
+        method = getattr(self._proxy, name)
+
+        def record(*args):
+            result = method(*args)
+            self._fixture.add(name, args, result)
+            return result
+        return record
+
+
+def record(proxy, location, resource_groups=(), vlans=('fe', 'srv')):
+    """Record the read-only calls of all localconfig scripts."""
+    fixture = Fixture()
+    d = Recorder(proxy, fixture)
+    d.list_nodes()
+    d.deletions('vm')
+    d.list_virtual_machines(location)
+    d.list_permissions()
+    d.list_users()
+    d.class_map('backupclient', 'location')
+    d.lookup_resourcegroup('admins')
+    for ipversion in (4, 6):
+        d.lookup_networks_details(location, ipversion)
+        d.list_nodes_addresses(location, '', ipversion)
+    for vlan in vlans:
+        d.list_addresses(vlan, location)
+    for rg in resource_groups:
+        d.list_users(rg)
+        d.lookup_resourcegroup(rg)
+    return fixture
+
+
+STAGES = [[], ['prepare'], ['prepare', 'soft'], ['prepare', 'soft', 'hard'],
+          ['prepare', 'soft', 'hard', 'purge']]
+VLANS = {'fe': 1, 'srv': 3}
+PERMISSIONS = ['login', 'manager', 'stats', 'sudo-srv', 'wheel']
+
+
+def generate(nodes=10000, location='dev', users=100, resource_groups=20,
+             deleted=0.01, seed=0):
+    """Create a consistent synthetic fixture.
+
+    Every node has an IPv4 and an IPv6 address on each of the fe and
+    srv VLANs. A fraction of `deleted` nodes is marked for deletion.
+    Users are spread across resource groups.
+    """
+    rnd = random.Random(seed)
+    fixture = Fixture()
+    list_nodes = []
+    addresses = {4: [], 6: []}
+    vlan_addresses = dict((vlan, []) for vlan in VLANS)
+    deletions = {}
+    for i in range(nodes):
+        name = 'vm{:05d}'.format(i)
+        rg = 'rg{:03d}'.format(i % resource_groups)
+        interfaces = {}
+        for vlan, vid in sorted(VLANS.items()):
+            mac = '02:00:00:{:02x}:{:02x}:{:02x}'.format(
+                vid, i // 256 % 256, i % 256)
+            ip4 = '10.{}.{}.{}'.format(vid, i // 250, i % 250 + 2)
+            ip6 = '2001:db8:{}::{:x}'.format(vid, i + 2)
+            interfaces[vlan] = {'mac': mac, 'networks': {
+                '10.{}.0.0/16'.format(vid): [ip4],
+                '2001:db8:{}::/64'.format(vid): [ip6]}}
+            addresses[4].append({'name': name, 'vlan': vlan, 'mac': mac,
+                                 'ip': ip4 + '/16'})
+            addresses[6].append({'name': name, 'vlan': vlan, 'mac': mac,
+                                 'ip': ip6 + '/64'})
+            vlan_addresses[vlan].extend(
+                {'name': name, 'rg': rg, 'addr': addr}
+                for addr in (ip4 + '/16', ip6 + '/64'))
+        list_nodes.append({'name': name, 'parameters': {
+            'location': location,
+            'production': rnd.random() < 0.7,
+            'resource_group': rg,
+            'interfaces': interfaces,
+            'reverses': {},
+            'backy_server': 'backup{:02d}'.format(i % 4),
+            'backy_schedule': rnd.choice(['default', 'frequent']),
+            'rbd_pool': rnd.choice(['rbd.hdd', 'rbd.ssd']),
+        }})
+        if rnd.random() < deleted:
+            deletions[name] = {'stages': rnd.choice(STAGES[1:])}
+    fixture.add('list_nodes', (), list_nodes)
+    fixture.add('list_virtual_machines', (location,), list_nodes)
+    fixture.add('deletions', ('vm',), deletions)
+    fixture.add('class_map', ('backupclient', 'location'), dict(
+        (n['name'], {'location': location}) for n in list_nodes))
+    for vlan, entries in vlan_addresses.items():
+        fixture.add('list_addresses', (vlan, location), entries)
+    for ipversion in (4, 6):
+        fixture.add('list_nodes_addresses', (location, '', ipversion),
+                    addresses[ipversion])
+        prefix = '10.{}.0.0/16' if ipversion == 4 else '2001:db8:{}::/64'
+        fixture.add('lookup_networks_details', (location, ipversion), dict(
+            (vlan, [{'cidr': prefix.format(vid), 'dhcp': True}])
+            for vlan, vid in VLANS.items()))
+    permissions = [{'name': name, 'id': 3000 + i, 'description': name}
+                   for i, name in enumerate(PERMISSIONS)]
+    all_users = []
+    fixture.add('list_permissions', (), permissions)
+    fixture.add('lookup_resourcegroup', ('admins',),
+                {'name': 'admins', 'gid': 2003})
+    for g in range(resource_groups):
+        rg = 'rg{:03d}'.format(g)
+        fixture.add('lookup_resourcegroup', (rg,),
+                    {'name': rg, 'gid': 4000 + g})
+        rg_users = []
+        for u in range(users):
+            uid = 'user{:03d}{:04d}'.format(g, u)
+            rg_users.append({
+                'uid': uid,
+                'class': 'human',
+                'id': 10000 + g * users + u,
+                'gid': 100,
+                'name': 'User {} {}'.format(g, u),
+                'password': '{crypt}$6$salt$' + uid,
+                'login_shell': '/bin/bash',
+                'home_directory': '/home/' + uid,
+                'ssh_pubkey': ['ssh-ed25519 AAAA{} {}@example.com'.format(
+                    rnd.getrandbits(128), uid)],
+                'permissions': {rg: rnd.sample(PERMISSIONS, 2)}})
+        fixture.add('list_users', (rg,), rg_users)
+        all_users.extend(rg_users)
+    fixture.add('list_users', (), all_users)
+    return fixture
+
+
+def main():
+    a = argparse.ArgumentParser(description='Fake directory server.')
+    sub = a.add_subparsers(dest='command')
+    s = sub.add_parser('serve', help='serve responses from FIXTURE')
+    s.add_argument('-b', '--bind', default='localhost',
+                   help='address to listen on (default: %(default)s)')
+    s.add_argument('-p', '--port', default=8080, type=int,
+                   help='port to listen on (default: %(default)s)')
+    s.add_argument('fixture', metavar='FIXTURE')
+    g = sub.add_parser('generate', help='write synthetic FIXTURE')
+    g.add_argument('-n', '--nodes', default=10000, type=int,
+                   help='number of nodes (default: %(default)s)')
+    g.add_argument('-u', '--users', default=100, type=int,
+                   help='users per resource group (default: %(default)s)')
+    g.add_argument('-r', '--resource-groups', default=20, type=int,
+                   help='number of resource groups (default: %(default)s)')
+    g.add_argument('-l', '--location', default='dev',
+                   help='location id (default: %(default)s)')
+    g.add_argument('-d', '--deleted', default=0.01, type=float,
+                   help='fraction of nodes marked for deletion '
+                   '(default: %(default)s)')
+    g.add_argument('fixture', metavar='FIXTURE')
+    r = sub.add_parser('record',
+                       help='record responses of the real directory')
+    r.add_argument('-l', '--location', required=True, help='location id')
+    r.add_argument('-r', '--resource-group', action='append', default=[],
+                   help='record users of RESOURCE_GROUP (may be repeated)')
+    r.add_argument('fixture', metavar='FIXTURE')
+    args = a.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'serve':
+        s = server(Fixture.load(args.fixture), args.bind, args.port)
+        _log.info('serving %s on http://%s:%s/', args.fixture,
+                  *s.server_address[:2])
+        s.serve_forever()
+    elif args.command == 'generate':
+        generate(args.nodes, args.location, args.users,
+                 args.resource_groups, args.deleted).save(args.fixture)
+    elif args.command == 'record':
+        with gocept.net.directory.exceptions_screened():
+            fixture = record(gocept.net.directory.Directory(cache_ttl=0),
+                             args.location, args.resource_group)
+        fixture.save(args.fixture)
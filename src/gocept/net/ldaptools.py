@@ -1,7 +1,9 @@
 # Copyright (c) 2009 gocept gmbh & co. kg
 # See also LICENSE.txt
 
+from ldap.controls import SimplePagedResultsControl
 import ldap
+import ldap.dn
 
 
 def load_ldapconf(filename):
@@ -17,13 +19,68 @@ def load_ldapconf(filename):
     return data
 
 
-def search(server, base, filter):
-    id = server.search(base, ldap.SCOPE_ONELEVEL, filter, None)
+class CountingServer(object):
+    """LDAP connection proxy which counts search requests in `searches`.
+
+    Paged searches send a separate request for each page.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.searches = 0
+
+    def search_ext(self, *args, **kw):
+        self.searches += 1
+        return self.server.search_ext(*args, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+
+def search(server, base, filter, scope=ldap.SCOPE_ONELEVEL, attrlist=None,
+           dn=False, page_size=None):
+    """Generate entries found below `base`.
+
+    Entries are attribute dicts restricted to `attrlist` (all attributes
+    if None) or (dn, attributes) tuples if `dn` is true. Results are
+    retrieved in bulk. If `page_size` is given, the Simple Paged Results
+    control (RFC 2696) is used to retrieve at most `page_size` entries
+    per request, so that the server's size limit is not hit.
+    """
+    if page_size:
+        pages = _paged(server, base, scope, filter, attrlist, page_size)
+    else:
+        msgid = server.search_ext(base, scope, filter, attrlist)
+        pages = [server.result3(msgid)[1]]
+    for page in pages:
+        for entry_dn, attrs in page:
+            if entry_dn is None:
+                # search continuation reference
+                continue
+            yield (entry_dn, attrs) if dn else attrs
+
+
+def _paged(server, base, scope, filter, attrlist, page_size):
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
     while True:
-        type, data = server.result(id, 0)
-        if data == []:
+        msgid = server.search_ext(
+            base, scope, filter, attrlist, serverctrls=[control])
+        _type, data, _msgid, controls = server.result3(msgid)
+        yield data
+        cookies = [c.cookie for c in controls if c.controlType ==
+                   SimplePagedResultsControl.controlType]
+        if not cookies or not cookies[0]:
             return
-        if type == ldap.RES_SEARCH_ENTRY:
-            yield data[0][1]
+        control.cookie = cookies[0]
+
+
+def normalize_dn(dn):
+    """Canonical lower-case form of `dn` for comparisons."""
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
+
+
+def parent_dn(dn):
+    """Normalized DN of the parent entry of `dn`."""
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:]).lower()
 
 
@@ -13,6 +13,7 @@ import StringIO
 import subprocess
 import time
 import socket
+import xmlrpclib
 
 HOST = socket.gethostname()
 LOG = logging.getLogger(__name__)
@@ -293,32 +294,24 @@ class ReqManager(object):
                 LOG.debug('exception: %s', e)
                 return
 
-    @require_lock
-    @require_directory
-    def postpone_requests(self):
-        """Instructs directory to postpone requests.
+    def _postponed(self):
+        """List requests which should be postponed."""
+        return [req for req in self.requests().values()
+                if req.state is gocept.net.maintenance.Request.POSTPONE]
 
-        Postponed requests get their new scheduled time with the next
-        schedule call.
-        """
-        requests = []
-        for req in self.requests().values():
-            if req.state is gocept.net.maintenance.Request.POSTPONE:
-                requests.append(req)
-        if not requests:
-            return
+    def _postpone_args(self, requests):
         postpone = dict((req.uuid, {'postpone_by': req.estimate})
                         for req in requests)
         LOG.debug('invoking postpone_maintenance(%r)', postpone)
-        self.directory.postpone_maintenance(postpone)
+        return postpone
+
+    def _reset_postponed(self, requests):
         for req in requests:
             req.reset_started_stopped()
             req.update(starttime=None)
 
-    @require_lock
-    @require_directory
-    def archive_requests(self):
-        """Move all completed requests to archivedir."""
+    def _completed(self):
+        """Dict of all completed requests keyed by reqid."""
         archive = {}
         for request in self.requests().values():
             if request.state in (gocept.net.maintenance.Request.SUCCESS,
@@ -326,15 +319,68 @@ class ReqManager(object):
                                  gocept.net.maintenance.Request.RETRYLIMIT,
                                  gocept.net.maintenance.Request.DELETED):
                 archive[request.reqid] = request
-        if not archive:
-            return
+        return archive
+
+    def _end_args(self, archive):
         finished = dict((req.uuid, {
             'duration': req.executiontime,
             'result': req.state})
             for req in archive.values())
         LOG.debug('invoking end_maintenance(%r)', finished)
-        self.directory.end_maintenance(finished)
+        return finished
+
+    def _archive(self, archive):
         for reqid, request in archive.iteritems():
             LOG.info('(req %s) completed, archiving request', request.uuid)
             os.rename(os.path.join(self.requestsdir, str(reqid)),
                       os.path.join(self.archivedir, str(reqid)))
+
+    @require_lock
+    @require_directory
+    def postpone_requests(self):
+        """Instructs directory to postpone requests.
+
+        Postponed requests get their new scheduled time with the next
+        schedule call.
+        """
+        requests = self._postponed()
+        if not requests:
+            return
+        self.directory.postpone_maintenance(self._postpone_args(requests))
+        self._reset_postponed(requests)
+
+    @require_lock
+    @require_directory
+    def archive_requests(self):
+        """Move all completed requests to archivedir."""
+        archive = self._completed()
+        if not archive:
+            return
+        self.directory.end_maintenance(self._end_args(archive))
+        self._archive(archive)
+
+    @require_lock
+    @require_directory
+    def postpone_and_archive_requests(self):
+        """Combination of `postpone_requests` and `archive_requests`.
+
+        Both directory calls are sent in a single request. The directory
+        performs each of them even if the other one fails, so local state
+        is updated for every call which succeeded before the first fault
+        is raised.
+        """
+        postponed = self._postponed()
+        archive = self._completed()
+        batch = gocept.net.directory.Batch(self.directory, faults=True)
+        if postponed:
+            batch.postpone_maintenance(self._postpone_args(postponed))
+        if archive:
+            batch.end_maintenance(self._end_args(archive))
+        results = batch()
+        failed = [r for r in results if isinstance(r, xmlrpclib.Fault)]
+        if postponed and not isinstance(results.pop(0), xmlrpclib.Fault):
+            self._reset_postponed(postponed)
+        if archive and not isinstance(results.pop(0), xmlrpclib.Fault):
+            self._archive(archive)
+        if failed:
+            raise failed[0]
@@ -94,8 +94,7 @@ and executed if due. Finished requests are archived.""")
     with gocept.net.maintenance.ReqManager(opts.spooldir) as rm:
         rm.execute_requests()
         with gocept.net.directory.exceptions_screened():
-            rm.postpone_requests()
-            rm.archive_requests()
+            rm.postpone_and_archive_requests()
 
 
 def list():
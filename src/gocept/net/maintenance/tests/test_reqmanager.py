@@ -13,6 +13,7 @@ import pytest
 import pytz
 import time
 import uuid as pyuuid
+import xmlrpclib
 
 
 @pytest.yield_fixture
@@ -264,6 +265,51 @@ def test_archive(tmpdir, dir_fac):
             request.uuid: {'duration': 0, 'result': 'success'}})
 
 
+def test_postpone_and_archive_in_single_request(tmpdir, dir_fac):
+    directory = dir_fac.return_value
+    directory.system.multicall.return_value = [[None], [None]]
+    with freezegun.freeze_time('2011-07-27 07:12:00', tz_offset=0):
+        with ReqManager(str(tmpdir)) as rm:
+            postponed = rm.add_request(300, script='exit 69')
+            postponed.starttime = now()
+            postponed.save()
+            postponed.execute()
+            done = rm.add_request(1, script='exit 0')
+            done.execute()
+            rm.postpone_and_archive_requests()
+            postponed = rm.load_request(postponed.reqid)
+            assert postponed.state == Request.PENDING
+            assert os.path.exists(rm.archivedir + '/' + str(done.reqid))
+    directory.system.multicall.assert_called_once_with([
+        {'methodName': 'postpone_maintenance',
+         'params': ({postponed.uuid: {'postpone_by': 300}},)},
+        {'methodName': 'end_maintenance',
+         'params': ({done.uuid: {'duration': 0, 'result': 'success'}},)}])
+    assert not directory.postpone_maintenance.called
+    assert not directory.end_maintenance.called
+
+
+def test_failed_postpone_still_archives_ended_requests(tmpdir, dir_fac):
+    directory = dir_fac.return_value
+    directory.system.multicall.return_value = [
+        {'faultCode': 1, 'faultString': 'postpone failed'}, [None]]
+    with freezegun.freeze_time('2011-07-27 07:12:00', tz_offset=0):
+        with ReqManager(str(tmpdir)) as rm:
+            postponed = rm.add_request(300, script='exit 69')
+            postponed.starttime = now()
+            postponed.save()
+            postponed.execute()
+            done = rm.add_request(1, script='exit 0')
+            done.execute()
+            with pytest.raises(xmlrpclib.Fault):
+                rm.postpone_and_archive_requests()
+            postponed = rm.load_request(postponed.reqid)
+            assert postponed.state == Request.POSTPONE
+            assert os.path.exists(rm.archivedir + '/' + str(done.reqid))
+            assert not os.path.exists(
+                rm.requestsdir + '/' + str(done.reqid))
+
+
 def test_str(tmpdir, tz_utc):
     with freezegun.freeze_time('2011-07-28 11:03:00', tz_offset=0):
         with request_population(3, tmpdir) as (rm, req):
@@ -2,10 +2,12 @@
 
 import cStringIO
 import datetime
-import difflib
+import gocept.net.configfile
+import gocept.net.diff
 import gocept.net.utils
 import locale
 import os
+import stat
 import time
 
 
@@ -20,7 +22,79 @@ def check_link_count(file):
     return 1
 
 
+class Records(list):
+    """List of database entries which keeps the database's indexes current.
+    """
+
+    def __init__(self, db, records=()):
+        list.__init__(self, records)
+        self.db = db
+
+    def append(self, record):
+        list.append(self, record)
+        self.db._add(record)
+
+    def extend(self, records):
+        records = list(records)
+        list.extend(self, records)
+        for record in records:
+            self.db._add(record)
+
+    def __iadd__(self, records):
+        self.extend(records)
+        return self
+
+    def remove(self, record):
+        list.remove(self, record)
+        self.db._discard(record)
+
+    def pop(self, index=-1):
+        record = list.pop(self, index)
+        self.db._discard(record)
+        return record
+
+    # Operations which may change the order of entries with the same key
+    # rebuild all indexes.
+
+    def insert(self, index, record):
+        list.insert(self, index, record)
+        self.db._reindex()
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self.db._reindex()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.db._reindex()
+
+    def __setslice__(self, i, j, records):
+        list.__setslice__(self, i, j, records)
+        self.db._reindex()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.db._reindex()
+
+    def sort(self, *args, **kw):
+        list.sort(self, *args, **kw)
+        self.db._reindex()
+
+    def reverse(self):
+        list.reverse(self)
+        self.db._reindex()
+
+
 class Database(object):
+    """Colon-separated database file like /etc/passwd.
+
+    Entries are indexed by their key and by the fields listed in
+    `indexes`. The indexes follow changes to `records` and to indexed
+    fields of its entries. An entry must not be part of several
+    databases at the same time.
+    """
+
+    indexes = ()
 
     def __init__(self, path):
         self.path = path
@@ -28,46 +102,128 @@ class Database(object):
 
     def open(self):
         self.lock()
-        self.records = []
+        records = []
         for line in open(self.path):
-            line = line.rstrip()
-            self.records.append(self.factory.fromString(line))
+            line = line.rstrip('\n')
+            records.append(self.factory.fromString(line))
+        self._records = Records(self, records)
+        self._reindex()
+
+    @property
+    def records(self):
+        return self._records
+
+    @records.setter
+    def records(self, records):
+        self._records = Records(self, records)
+        self._reindex()
+
+    @records.deleter
+    def records(self):
+        for record in self._records:
+            record._db = None
+        del self._records
+        del self._index
+
+    def _reindex(self):
+        self._index = dict((field, {}) for field in
+                           (self.factory.key,) + tuple(self.indexes))
+        for record in self._records:
+            self._add(record)
+
+    def _add(self, record):
+        record._db = self
+        for field, index in self._index.items():
+            value = getattr(record, field, None)
+            if value is not None:
+                index.setdefault(value, []).append(record)
+
+    def _discard(self, record):
+        record._db = None
+        for field in self._index:
+            self._unindex(record, field, getattr(record, field, None))
+
+    def _unindex(self, record, field, value):
+        entries = self._index[field].get(value, [])
+        entries[:] = [e for e in entries if e is not record]
+        if not entries:
+            self._index[field].pop(value, None)
+
+    def _changed(self, record, field, old, new):
+        """Move `record` in the index of `field` from `old` to `new`."""
+        if field not in self._index or old == new:
+            return
+        if old is not None:
+            self._unindex(record, field, old)
+        if new is not None:
+            entries = self._index[field].setdefault(new, [])
+            entries.append(record)
+            if len(entries) > 1:
+                # Keep entries in file order.
+                position = dict((id(r), i) for i, r in enumerate(
+                    self._records))
+                entries.sort(key=lambda r: position[id(r)])
+
+    def find(self, field, value):
+        """Return entries whose indexed `field` equals `value`."""
+        return list(self._index[field].get(value, ()))
 
     def close(self):
         self.unlock()
         del self.records
 
-    def _dump(self):
+    def render(self):
+        """Return the file contents for the current records."""
         output = cStringIO.StringIO()
         for record in self.records:
             output.write(record.toString() + '\n')
-        output.seek(0)
-        return output
+        return output.getvalue()
+
+    def _diff(self, old, new):
+        return list(gocept.net.diff.unified_diff(
+            old.splitlines(True), new.splitlines(True), 'old', 'new'))
 
     def diff(self):
-        new = self._dump()
-        old = open(self.path, 'r')
-        delta = difflib.unified_diff(
-            old.readlines(), new.readlines(), "old", "new")
-        old.close()
-        return list(delta)
+        with open(self.path) as f:
+            return self._diff(f.read(), self.render())
+
+    def _write(self, filename, contents, st):
+        """Write `contents` to `filename` with owner and mode from `st`."""
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+            f.flush()
+            if (st.st_uid, st.st_gid) != (os.geteuid(), os.getegid()):
+                os.fchown(fd, st.st_uid, st.st_gid)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            gocept.net.configfile.datasync(fd)
 
     def save(self):
-        # We need to assemble the contents of the file first, otherwise
-        # opening it for writing and then failing will cause it to become
-        # empty.
-        if self.diff():
-            f = open(self.path, 'w')
-            f.write(self._dump().getvalue())
-            f.close()
+        """Write records to the file if they differ from its contents.
+
+        Like shadow-utils, the old contents are kept in a backup file
+        with a trailing dash (e.g. passwd-) and the new contents are
+        written to a file with a trailing plus which is renamed into
+        place. Returns a tuple of a change flag and the diff lines.
+        """
+        new = self.render()
+        with open(self.path) as f:
+            st = os.fstat(f.fileno())
+            old = f.read()
+        if new == old:
+            return False, []
+        self._write(self.path + '-', old, st)
+        self._write(self.path + '+', new, st)
+        os.rename(self.path + '+', self.path)
+        return True, self._diff(old, new)
 
     def unlock(self):
         os.unlink(self.path + '.lock')
 
     def get(self, key, create=False):
-        for item in self.records:
-            if getattr(item, self.factory.key) == key:
-                return item
+        entries = self._index[self.factory.key].get(key)
+        if entries:
+            return entries[0]
         if create:
             item = self.factory(key)
             self.records.append(item)
@@ -202,26 +358,75 @@ class Database(object):
 
 
 class DatabaseEntry(object):
+    """Single colon-separated record.
+
+    Entries read from a file keep the original line and split it into
+    fields only when they are accessed. Entries whose fields have not
+    been changed are written back verbatim.
+    """
+
+    __slots__ = ('_line', '_values', '_db')
 
     fields = ()
 
+    def __new__(cls, *args, **kw):
+        self = object.__new__(cls)
+        self._line = None
+        self._values = [None] * len(cls.fields)
+        self._db = None
+        return self
+
     @classmethod
     def fromString(cls, data):
-        data = data.split(':')
-        if len(data) != len(cls.fields):
-            raise RuntimeError('mismatching record length', data, cls.fields)
-        data = dict(zip(cls.fields, data))
-        entry = cls(data.pop(cls.key))
-        for key, value in data.items():
-            setattr(entry, key, value)
+        if data.count(':') != len(cls.fields) - 1:
+            raise RuntimeError(
+                'mismatching record length', data.split(':'), cls.fields)
+        entry = object.__new__(cls)
+        entry._line = data
+        entry._values = None
+        entry._db = None
         return entry
 
+    def __getattr__(self, name):
+        try:
+            i = self.fields.index(name)
+        except ValueError:
+            raise AttributeError(name)
+        if self._values is None:
+            return self._line.split(':', i + 1)[i]
+        value = self._values[i]
+        if value is None:
+            raise AttributeError(name)
+        return value
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+            return
+        try:
+            i = self.fields.index(name)
+        except ValueError:
+            raise AttributeError(name)
+        old = getattr(self, name, None)
+        if old is not None and old == value:
+            return
+        if self._values is None:
+            self._values = self._line.split(':')
+        self._values[i] = value
+        self._line = None
+        if self._db is not None:
+            self._db._changed(self, name, old, value)
+
     def toString(self):
+        if self._line is not None:
+            return self._line
         return ':'.join(getattr(self, field) for field in self.fields)
 
 
 class PasswdEntry(DatabaseEntry):
 
+    __slots__ = ()
+
     fields = ['login_name',
               'password',
               'uid',
@@ -242,10 +447,13 @@ class PasswdEntry(DatabaseEntry):
 class Passwd(Database):
 
     factory = PasswdEntry
+    indexes = ('uid',)
 
 
 class GroupEntry(DatabaseEntry):
 
+    __slots__ = ()
+
     fields = ['group',
               'password',
               'gid',
@@ -268,10 +476,13 @@ class GroupEntry(DatabaseEntry):
 class Group(Database):
 
     factory = GroupEntry
+    indexes = ('gid',)
 
 
 class ShadowEntry(DatabaseEntry):
 
+    __slots__ = ()
+
     fields = ['login',
               'password',
               'lastchange',
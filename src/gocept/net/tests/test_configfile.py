@@ -1,10 +1,16 @@
 # Copyright (c) 2011 gocept gmbh & co. kg
 # See also LICENSE.txt
 
-from gocept.net.configfile import ConfigFile
+from gocept.net.configfile import ConfigFile, ConfigFileGroup
+from gocept.net.configfile import FingerprintStore, ManagedDirectory
+from gocept.net.configfile import copy_file
 import cStringIO
+import errno
+import gocept.net.configfile
+import mock
 import os
 import os.path
+import shutil
 import tempfile
 import unittest
 
@@ -60,6 +66,28 @@ class TestConfigFile(unittest.TestCase):
 +hello world 2
 """.format(fn=self.tf.name))
 
+    def test_diff_is_truncated(self):
+        with open(self.tf.name, 'w') as f:
+            f.write(''.join('old {}\n'.format(i) for i in range(10)))
+        c = ConfigFile(self.tf.name, stdout=self.diffout)
+        c.diff_lines = 5
+        c.write(''.join('new {}\n'.format(i) for i in range(10)))
+        c.commit()
+        self.assertEquals(
+            '[diff truncated after 5 lines: 10 lines added, 10 lines '
+            'removed in total]\n',
+            self.diffout.getvalue().splitlines(True)[-1])
+
+    def test_quiet_skips_diff(self):
+        with open(self.tf.name, 'w') as f:
+            f.write('old\n')
+        with mock.patch.object(ConfigFile, 'quiet', True), \
+                mock.patch('gocept.net.diff.unified_diff') as diff:
+            c = ConfigFile(self.tf.name)
+            c.write('new\n')
+            self.assertTrue(c.commit())
+        self.assertFalse(diff.called)
+
     def test_dont_touch_unchanged(self):
         with open(self.tf.name, 'w') as f:
             print >>f, 'hello world'
@@ -71,3 +99,314 @@ class TestConfigFile(unittest.TestCase):
         after = os.stat(self.tf.name)
         self.assertEquals(before, after)
         self.assertEquals('', self.diffout.getvalue())
+
+
+class TestConfigFileGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.diffout = cStringIO.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_commit_returns_changed_files(self):
+        with open(self.path('same'), 'w') as f:
+            f.write('same\n')
+        with open(self.path('old'), 'w') as f:
+            f.write('old\n')
+        before = os.stat(self.path('same'))
+        group = ConfigFileGroup(self.diffout)
+        print >>group.open(self.path('same')), 'same'
+        print >>group.open(self.path('old')), 'new'
+        print >>group.open(self.path('created')), 'created'
+        self.assertEquals(set([self.path('old'), self.path('created')]),
+                          group.commit())
+        self.assertEquals(before, os.stat(self.path('same')))
+        self.assertEquals('new\n', open(self.path('old')).read())
+        self.assertEquals('created\n', open(self.path('created')).read())
+        self.assertIn('-old\n+new\n', self.diffout.getvalue())
+        self.assertEquals(['created', 'old', 'same'],
+                          sorted(os.listdir(self.dir)))
+
+    def test_keeps_mode_of_existing_files(self):
+        with open(self.path('old'), 'w') as f:
+            f.write('old\n')
+        os.chmod(self.path('old'), 0o640)
+        group = ConfigFileGroup(self.diffout)
+        group.open(self.path('old')).write('new\n')
+        group.open(self.path('created'), mode=0o600).write('created\n')
+        group.commit()
+        self.assertEquals(0o640, os.stat(self.path('old')).st_mode & 0o777)
+        self.assertEquals(
+            0o600, os.stat(self.path('created')).st_mode & 0o777)
+
+    def test_single_syncfs_for_many_files(self):
+        group = ConfigFileGroup(self.diffout)
+        group.syncfs_threshold = 3
+        for i in range(5):
+            group.open(self.path(str(i))).write('file {}\n'.format(i))
+        with mock.patch('gocept.net.configfile.syncfs') as syncfs, \
+                mock.patch('gocept.net.configfile.datasync') as datasync:
+            syncfs.return_value = True
+            self.assertEquals(5, len(group.commit()))
+        self.assertEquals(1, syncfs.call_count)
+        self.assertFalse(datasync.called)
+
+    def test_datasync_per_file_for_few_files(self):
+        group = ConfigFileGroup(self.diffout)
+        for i in range(2):
+            group.open(self.path(str(i))).write('file {}\n'.format(i))
+        with mock.patch('gocept.net.configfile.syncfs') as syncfs, \
+                mock.patch('gocept.net.configfile.datasync') as datasync:
+            group.commit()
+        self.assertFalse(syncfs.called)
+        self.assertEquals(2, datasync.call_count)
+
+    def test_failed_commit_leaves_no_temporary_files(self):
+        group = ConfigFileGroup(self.diffout)
+        group.open(self.path('a')).write('a\n')
+        group.open(self.path('b')).write('b\n')
+        with mock.patch('gocept.net.configfile.datasync') as datasync:
+            datasync.side_effect = OSError(5, 'I/O error')
+            self.assertRaises(OSError, group.commit)
+        self.assertEquals([], os.listdir(self.dir))
+
+
+class TestAtomicConfigFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'file')
+        self.diffout = cStringIO.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replaces_file_keeping_mode(self):
+        with open(self.filename, 'w') as f:
+            f.write('old\n')
+        os.chmod(self.filename, 0o604)
+        old = open(self.filename)
+        c = ConfigFile(self.filename, self.diffout)
+        c.write('new\n')
+        self.assertTrue(c.commit())
+        # readers of the old file still see complete old contents
+        self.assertEquals('old\n', old.read())
+        self.assertEquals('new\n', open(self.filename).read())
+        self.assertEquals(0o604, os.stat(self.filename).st_mode & 0o777)
+        self.assertEquals(['file'], os.listdir(self.dir))
+
+    def test_replaces_symlink_target(self):
+        with open(self.filename, 'w') as f:
+            f.write('old\n')
+        link = os.path.join(self.dir, 'link')
+        os.symlink('file', link)
+        c = ConfigFile(link, self.diffout)
+        c.write('new\n')
+        c.commit()
+        self.assertTrue(os.path.islink(link))
+        self.assertEquals('new\n', open(self.filename).read())
+
+    def test_in_place_mode(self):
+        with open(self.filename, 'w') as f:
+            f.write('old\n')
+        inode = os.stat(self.filename).st_ino
+        c = ConfigFile(self.filename, self.diffout, atomic=False)
+        c.write('new\n')
+        self.assertTrue(c.commit())
+        self.assertEquals(inode, os.stat(self.filename).st_ino)
+        self.assertEquals('new\n', open(self.filename).read())
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'file')
+        self.store = FingerprintStore(os.path.join(self.dir, 'fingerprints'))
+        self.diffout = cStringIO.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def commit(self, contents, atomic=True):
+        c = ConfigFile(self.filename, self.diffout, atomic=atomic)
+        c.fingerprints = self.store
+        c.write(contents)
+        return c.commit()
+
+    def test_unchanged_contents_are_not_read(self):
+        self.assertTrue(self.commit('contents\n'))
+        opened = []
+
+        def spy(name, *args):
+            opened.append(name)
+            return open(name, *args)
+        with mock.patch('gocept.net.configfile.open', spy, create=True):
+            self.assertFalse(self.commit('contents\n'))
+        self.assertNotIn(self.filename, opened)
+
+    def test_unchanged_contents_in_place(self):
+        self.assertTrue(self.commit('contents\n', atomic=False))
+        self.assertFalse(self.commit('contents\n', atomic=False))
+        self.assertTrue(self.commit('new contents\n', atomic=False))
+
+    def test_manual_edits_are_noticed(self):
+        self.commit('contents\n')
+        with open(self.filename, 'w') as f:
+            f.write('edited\n')
+        self.assertTrue(self.commit('contents\n'))
+        self.assertEquals('contents\n', open(self.filename).read())
+
+    def test_fingerprint_is_recorded_after_comparison(self):
+        with open(self.filename, 'w') as f:
+            f.write('contents\n')
+        self.assertFalse(self.commit('contents\n'))
+        st = os.stat(self.filename)
+        self.assertIsNotNone(self.store.get(self.filename, st))
+
+
+class TestSpooledConfigFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'file')
+        self.diffout = cStringIO.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def configfile(self, **kw):
+        c = ConfigFile(self.filename, self.diffout, **kw)
+        c.spool_size = 10
+        c.chunk_size = 4
+        return c
+
+    def test_large_contents_are_spooled_and_renamed(self):
+        c = self.configfile()
+        c.write('line 1\n')
+        self.assertIsNone(c.spooled)
+        print >>c, 'line 2'
+        spooled = c.spooled
+        self.assertTrue(os.path.exists(spooled))
+        self.assertEquals('line 1\nline 2\n', c.getvalue())
+        self.assertTrue(c.commit())
+        self.assertEquals('line 1\nline 2\n', open(self.filename).read())
+        self.assertEquals(['file'], os.listdir(self.dir))
+
+    def test_unchanged_spooled_contents(self):
+        with open(self.filename, 'w') as f:
+            f.write('line 1\nline 2\n')
+        c = self.configfile()
+        c.writelines(['line 1\n', 'line 2\n'])
+        self.assertFalse(c.commit())
+        self.assertEquals(['file'], os.listdir(self.dir))
+
+    def test_spooled_contents_differing_in_last_chunk(self):
+        with open(self.filename, 'w') as f:
+            f.write('line 1\nline 2\n')
+        c = self.configfile()
+        c.write('line 1\nline 3\n')
+        self.assertTrue(c.commit())
+        self.assertEquals('{}: 14 bytes -> 14 bytes (not diffed)\n'.format(
+            self.filename), self.diffout.getvalue())
+        self.assertEquals('line 1\nline 3\n', open(self.filename).read())
+
+    def test_large_old_file_is_not_diffed(self):
+        with open(self.filename, 'w') as f:
+            f.write('line 1\nline 2\n')
+        c = self.configfile()
+        c.write('new\n')
+        self.assertTrue(c.commit())
+        self.assertIn('14 bytes -> 4 bytes', self.diffout.getvalue())
+
+    def test_spool_file_is_removed_if_not_committed(self):
+        c = self.configfile()
+        c.write('line 1\nline 2\n')
+        self.assertEquals(1, len(os.listdir(self.dir)))
+        del c
+        self.assertEquals([], os.listdir(self.dir))
+
+    def test_spooled_contents_in_place(self):
+        with open(self.filename, 'w') as f:
+            f.write('old\n')
+        c = self.configfile(atomic=False)
+        c.write('line 1\nline 2\n')
+        self.assertTrue(c.commit())
+        self.assertEquals('line 1\nline 2\n', open(self.filename).read())
+        self.assertEquals(['file'], os.listdir(self.dir))
+
+
+class TestManagedDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.managed = ManagedDirectory(self.dir, '*.cfg',
+                                        cStringIO.StringIO())
+        for name in ['a.cfg', 'b.cfg', 'stale.cfg', 'other']:
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(name + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sync(self):
+        changes = self.managed.sync({'a.cfg': 'a.cfg\n', 'b.cfg': 'new\n',
+                                     'c.cfg': 'c.cfg\n'})
+        self.assertEquals((['c.cfg'], ['b.cfg'], ['stale.cfg']), changes)
+        self.assertTrue(changes)
+        self.assertEquals(['a.cfg', 'b.cfg', 'c.cfg', 'other'],
+                          sorted(os.listdir(self.dir)))
+        self.assertEquals('new\n',
+                          open(os.path.join(self.dir, 'b.cfg')).read())
+
+    def test_sync_unchanged(self):
+        self.managed.sync({'a.cfg': 'a.cfg\n', 'b.cfg': 'b.cfg\n'})
+        changes = self.managed.sync({'a.cfg': 'a.cfg\n',
+                                     'b.cfg': 'b.cfg\n'})
+        self.assertEquals(([], [], []), changes)
+        self.assertFalse(changes)
+
+    def test_sync_creates_directory(self):
+        managed = ManagedDirectory(os.path.join(self.dir, 'new'))
+        self.assertEquals((['x'], [], []), managed.sync({'x': 'x\n'}))
+
+    def test_remove_ignores_missing_and_unmanaged_files(self):
+        changes = self.managed.remove(['a.cfg', 'missing.cfg', 'other'])
+        self.assertEquals(([], [], ['a.cfg']), changes)
+        self.assertEquals(['b.cfg', 'other', 'stale.cfg'],
+                          sorted(os.listdir(self.dir)))
+
+
+class TestCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.dst = os.path.join(self.dir, 'dst')
+        with open(self.src, 'w') as f:
+            f.write('x' * 100000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def copy(self):
+        with open(self.src) as src, open(self.dst, 'w') as dst:
+            copy_file(src.fileno(), dst.fileno())
+        return open(self.dst).read()
+
+    def test_copy(self):
+        self.assertEquals('x' * 100000, self.copy())
+
+    @mock.patch('fcntl.ioctl', side_effect=IOError(errno.EOPNOTSUPP, ''))
+    def test_copy_without_reflink(self, ioctl):
+        self.assertEquals('x' * 100000, self.copy())
+
+    @mock.patch('fcntl.ioctl', side_effect=IOError(errno.EOPNOTSUPP, ''))
+    def test_copy_without_kernel_support(self, ioctl):
+        with mock.patch.object(gocept.net.configfile, '_libc', False):
+            self.assertEquals('x' * 100000, self.copy())
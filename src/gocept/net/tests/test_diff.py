@@ -0,0 +1,61 @@
+from gocept.net.diff import opcodes, unified_diff
+import difflib
+import random
+
+
+def apply(a, b, codes):
+    result = []
+    i = j = 0
+    for tag, i1, i2, j1, j2 in codes:
+        assert (i, j) == (i1, j1)
+        if tag == 'equal':
+            assert a[i1:i2] == b[j1:j2]
+        result.extend(b[j1:j2])
+        i, j = i2, j2
+    assert (i, j) == (len(a), len(b))
+    return result
+
+
+def test_opcodes_transform_a_into_b():
+    rnd = random.Random(0)
+    for _ in range(1000):
+        a = [rnd.choice('abcdefgh') + '\n' for _ in range(rnd.randint(0, 30))]
+        b = list(a)
+        for _ in range(rnd.randint(0, 6)):
+            pos = rnd.randint(0, len(b))
+            if rnd.random() < 0.5 and pos < len(b):
+                del b[pos]
+            else:
+                b.insert(pos, rnd.choice('abcxyz') + '\n')
+        assert b == apply(a, b, opcodes(a, b))
+
+
+def test_same_output_as_difflib_for_simple_changes():
+    a = ['line {}\n'.format(i) for i in range(1000)]
+    b = list(a)
+    for i in range(0, 1000, 97):
+        b[i] = 'changed {}\n'.format(i)
+    del b[500:510]
+    b.insert(700, 'inserted\n')
+    assert list(difflib.unified_diff(a, b, 'old', 'new')) == list(
+        unified_diff(a, b, 'old', 'new'))
+
+
+def test_no_output_for_equal_input():
+    assert [] == list(unified_diff(['a\n'], ['a\n']))
+
+
+def test_truncates_output_with_summary():
+    a = ['line {}\n'.format(i) for i in range(100)]
+    b = ['new {}\n'.format(i) for i in range(90)]
+    diff = list(unified_diff(a, b, 'old', 'new', max_lines=10))
+    assert 11 == len(diff)
+    assert ('[diff truncated after 10 lines: 90 lines added, 100 lines '
+            'removed in total]\n') == diff[-1]
+
+
+def test_regions_over_budget_are_replaced():
+    a = ['x\n', 'y\n'] * 100
+    b = ['y\n', 'x\n'] * 100
+    assert [('replace', 0, 200, 0, 200)] == opcodes(a, b, budget=100)
+    assert b == apply(a, b, opcodes(a, b))
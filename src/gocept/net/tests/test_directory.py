@@ -0,0 +1,599 @@
+from gocept.net.directory import Batch, DirectoryCache, CachedDirectory
+from gocept.net.directory import DirectoryMetrics, InstrumentedDirectory
+from gocept.net.directory import IncrementalListing
+from gocept.net.xmlrpc import RequestCounter
+import gocept.net.directory
+import json
+import mock
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import time
+import xmlrpclib
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return DirectoryCache(str(tmpdir / 'cache'), ttl=60)
+
+
+def test_localconfig_setting_from_defaults(tmpdir, monkeypatch):
+    defaults = tmpdir / 'defaults'
+    defaults.write('DIRECTORY_SERVER="https://example.com/directory"\n'
+                   'DIRECTORY_CACHE_TTL=30\n')
+    monkeypatch.setattr(gocept.net.directory, 'DEFAULTS', str(defaults))
+    monkeypatch.delenv('DIRECTORY_CACHE_TTL', raising=False)
+    assert '30' == gocept.net.directory.localconfig_setting(
+        'DIRECTORY_CACHE_TTL')
+    assert 'x' == gocept.net.directory.localconfig_setting('NONEXISTENT', 'x')
+    monkeypatch.setenv('DIRECTORY_CACHE_TTL', '0')
+    assert '0' == gocept.net.directory.localconfig_setting(
+        'DIRECTORY_CACHE_TTL')
+
+
+def test_directory_serves_stale_data_only_if_allowed(tmpdir, monkeypatch):
+    secret = tmpdir / 'directory.secret'
+    secret.write('secret\n')
+    monkeypatch.setenv('DIRECTORY_SERVER', 'http://localhost/')
+    monkeypatch.setenv('DIRECTORY_SECRET', str(secret))
+    monkeypatch.setenv('DIRECTORY_CACHE_DIR', str(tmpdir / 'cache'))
+    monkeypatch.setenv('DIRECTORY_CACHE_TTL', '60')
+    monkeypatch.setenv('DIRECTORY_STALE_TTL', '3600')
+    assert 0 == gocept.net.directory.Directory()._stale_ttl
+    d = gocept.net.directory.Directory(allow_stale=True)
+    assert 3600 == d._stale_ttl
+    assert 5 == d._stale_wait
+    assert 30 == d._refresh_proxy._transport.read_timeout
+
+
+def test_cache_miss_raises_keyerror(cache):
+    with pytest.raises(KeyError):
+        cache.get('list_nodes', ())
+
+
+def test_cache_roundtrip(cache):
+    result = [{'name': 'node00', 'parameters': {'location': 'dev'}}]
+    cache.set('list_nodes', ('dev',), result)
+    assert result == cache.get('list_nodes', ('dev',))
+    with pytest.raises(KeyError):
+        cache.get('list_nodes', ('rzob',))
+
+
+def test_cache_directory_is_private(cache):
+    cache.set('list_users', (), [])
+    assert 0o700 == os.stat(cache.path).st_mode & 0o777
+    for f in os.listdir(cache.path):
+        assert 0o600 == os.stat(os.path.join(cache.path, f)).st_mode & 0o777
+
+
+def test_expired_entries_are_ignored(cache):
+    cache.set('deletions', ('vm',), {})
+    filename = cache._filename('deletions', ('vm',))
+    old = time.time() - 61
+    os.utime(filename, (old, old))
+    with pytest.raises(KeyError):
+        cache.get('deletions', ('vm',))
+
+
+def test_corrupt_entries_are_ignored(cache):
+    cache.set('deletions', ('vm',), {})
+    with open(cache._filename('deletions', ('vm',)), 'w') as f:
+        f.write('<methodResponse')
+    with pytest.raises(KeyError):
+        cache.get('deletions', ('vm',))
+
+
+def test_unwritable_cache_is_not_fatal(tmpdir):
+    (tmpdir / 'cache').write('not a directory')
+    cache = DirectoryCache(str(tmpdir / 'cache'))
+    cache.set('deletions', ('vm',), {})
+    with pytest.raises(KeyError):
+        cache.get('deletions', ('vm',))
+
+
+def test_cached_directory_fetches_once(cache):
+    proxy = mock.Mock()
+    proxy.deletions.return_value = {'node00': {'stages': ['soft']}}
+    d = CachedDirectory(proxy, cache)
+    assert {'node00': {'stages': ['soft']}} == d.deletions('vm')
+    assert {'node00': {'stages': ['soft']}} == d.deletions('vm')
+    assert 1 == proxy.deletions.call_count
+    # A second proxy (i.e. another script) shares the cache.
+    other = mock.Mock()
+    assert {'node00': {'stages': ['soft']}} == CachedDirectory(
+        other, cache).deletions('vm')
+    assert not other.deletions.called
+
+
+def test_cached_directory_passes_writes(cache):
+    proxy = mock.Mock()
+    proxy.schedule_maintenance.return_value = {}
+    d = CachedDirectory(proxy, cache)
+    d.schedule_maintenance({})
+    d.schedule_maintenance({})
+    assert 2 == proxy.schedule_maintenance.call_count
+    assert not os.path.exists(cache.path)
+
+
+def test_cache_streaming_read(cache):
+    cache.set('list_nodes', (), [{'name': 'node00'}, {'name': 'node01'}])
+    result = cache.get('list_nodes', (), streaming=True)
+    assert not isinstance(result, list)
+    assert [{'name': 'node00'}, {'name': 'node01'}] == list(result)
+    cache.set('lookup_networks_details', ('dev', 4), {'srv': []})
+    assert {'srv': []} == cache.get(
+        'lookup_networks_details', ('dev', 4), streaming=True)
+
+
+def test_cached_directory_tees_streamed_results(cache):
+    proxy = mock.Mock()
+    proxy.list_nodes.return_value = (n for n in [{'name': 'node00'}, 1])
+    d = CachedDirectory(proxy, cache, streaming=True)
+    result = d.list_nodes()
+    with pytest.raises(KeyError):
+        cache.get('list_nodes', ())
+    assert [{'name': 'node00'}, 1] == list(result)
+    assert [{'name': 'node00'}, 1] == cache.get('list_nodes', ())
+    assert [{'name': 'node00'}, 1] == list(d.list_nodes())
+    assert 1 == proxy.list_nodes.call_count
+
+
+def test_abandoned_stream_is_not_cached(cache):
+    proxy = mock.Mock()
+    proxy.list_nodes.return_value = (n for n in [1, 2, 3])
+    d = CachedDirectory(proxy, cache, streaming=True)
+    result = d.list_nodes()
+    assert 1 == next(result)
+    result.close()
+    with pytest.raises(KeyError):
+        cache.get('list_nodes', ())
+    assert [] == os.listdir(cache.path)
+
+
+def test_batch_uses_single_multicall():
+    proxy = mock.Mock()
+    proxy.system.multicall.return_value = [[['alice']], [[{'name': 'x'}]]]
+    batch = Batch(proxy)
+    batch.list_users('test')
+    batch.list_permissions()
+    assert [['alice'], [{'name': 'x'}]] == batch()
+    proxy.system.multicall.assert_called_once_with([
+        {'methodName': 'list_users', 'params': ('test',)},
+        {'methodName': 'list_permissions', 'params': ()}])
+    assert not proxy.list_users.called
+    assert [] == batch.calls
+
+
+def test_batch_raises_individual_faults():
+    proxy = mock.Mock()
+    proxy.system.multicall.return_value = [
+        [None], {'faultCode': 1, 'faultString': 'no such group'}]
+    batch = Batch(proxy)
+    batch.list_users('test')
+    batch.lookup_resourcegroup('nonexistent')
+    with pytest.raises(xmlrpclib.Fault):
+        batch()
+
+
+def test_batch_returns_faults_if_asked_to():
+    proxy = mock.Mock()
+    proxy.system.multicall.return_value = [
+        {'faultCode': 1, 'faultString': 'no such group'}, [None]]
+    batch = Batch(proxy, faults=True)
+    batch.lookup_resourcegroup('nonexistent')
+    batch.end_maintenance({})
+    fault, result = batch()
+    assert 'no such group' == fault.faultString
+    assert result is None
+    proxy.system.multicall.side_effect = xmlrpclib.Fault(
+        -32601, 'method "system.multicall" is not supported')
+    proxy.lookup_resourcegroup.side_effect = xmlrpclib.Fault(1, 'no group')
+    batch.lookup_resourcegroup('nonexistent')
+    batch.end_maintenance({})
+    fault, result = batch()
+    assert 'no group' == fault.faultString
+    assert proxy.end_maintenance.called
+
+
+def test_batch_falls_back_to_individual_calls():
+    proxy = mock.Mock()
+    proxy.system.multicall.side_effect = xmlrpclib.Fault(
+        -32601, 'method "system.multicall" is not supported')
+    proxy.list_users.return_value = ['alice']
+    proxy.list_permissions.return_value = []
+    batch = Batch(proxy)
+    batch.list_users('test')
+    batch.list_permissions()
+    assert [['alice'], []] == batch()
+    proxy.list_users.assert_called_once_with('test')
+
+
+def test_batch_fallback_keeps_order_and_stops_at_first_failure():
+    proxy = mock.Mock()
+    proxy.system.multicall.side_effect = xmlrpclib.Fault(
+        -32601, 'method "system.multicall" is not supported')
+    proxy.postpone_maintenance.side_effect = xmlrpclib.Fault(1, 'error')
+    batch = Batch(proxy)
+    batch.postpone_maintenance({})
+    batch.end_maintenance({})
+    with pytest.raises(xmlrpclib.Fault):
+        batch()
+    assert not proxy.end_maintenance.called
+
+
+def test_read_only_batch_falls_back_to_concurrent_calls():
+    proxy = mock.Mock()
+    proxy.system.multicall.side_effect = xmlrpclib.Fault(
+        -32601, 'method "system.multicall" is not supported')
+    batch = Batch(proxy, read_only=True)
+    batch.list_users('test')
+    with mock.patch('gocept.net.directory.gather') as gather:
+        gather.return_value = [['alice']]
+        assert [['alice']] == batch()
+    gather.assert_called_once_with(proxy, [('list_users', ('test',))])
+
+
+def test_batch_without_calls_does_not_contact_directory():
+    proxy = mock.Mock()
+    assert [] == Batch(proxy)()
+    assert not proxy.system.multicall.called
+
+
+def test_batch_sends_only_uncached_calls(cache):
+    cache.set('list_permissions', (), [{'name': 'wheel'}])
+    proxy = mock.Mock()
+    proxy.system.multicall.return_value = [[['alice']], [{}]]
+    batch = Batch(CachedDirectory(proxy, cache))
+    batch.list_users('test')
+    batch.list_permissions()
+    batch.schedule_maintenance({})
+    assert [['alice'], [{'name': 'wheel'}], {}] == batch()
+    proxy.system.multicall.assert_called_once_with([
+        {'methodName': 'list_users', 'params': ('test',)},
+        {'methodName': 'schedule_maintenance', 'params': ({},)}])
+    assert ['alice'] == cache.get('list_users', ('test',))
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.current = threading.local()
+
+    def receive(self, wire):
+        """Simulate a request which receives `wire` bytes."""
+        received = self.current.received = RequestCounter()
+        received.wire += wire
+        return received
+
+
+def test_instrumented_directory_records_calls():
+    transport = FakeTransport()
+    proxy = mock.Mock()
+
+    def list_users(rg):
+        transport.receive(100)
+        return ['alice', 'bob']
+    proxy.list_users.side_effect = list_users
+    proxy.deletions.side_effect = xmlrpclib.Fault(1, 'error')
+    metrics = DirectoryMetrics()
+    d = InstrumentedDirectory(proxy, transport, metrics)
+    assert ['alice', 'bob'] == d.list_users('test')
+    d.list_users('test')
+    with pytest.raises(xmlrpclib.Fault):
+        d.deletions('vm')
+    users = metrics.methods['list_users']
+    assert 2 == users['calls']
+    assert 200 == users['bytes']
+    assert 4 == users['objects']
+    assert 1 == metrics.methods['deletions']['errors']
+
+
+def test_instrumented_directory_attributes_multicall_entries():
+    transport = FakeTransport()
+    proxy = mock.Mock()
+
+    def multicall(calls):
+        transport.receive(300)
+        return [[['alice', 'bob']], {'faultCode': 1, 'faultString': 'x'},
+                [{'name': 'vm00'}]]
+    proxy.system.multicall.side_effect = multicall
+    metrics = DirectoryMetrics()
+    d = InstrumentedDirectory(proxy, transport, metrics)
+    d.system.multicall([
+        {'methodName': 'list_users', 'params': ['test']},
+        {'methodName': 'deletions', 'params': ['vm']},
+        {'methodName': 'list_nodes', 'params': []}])
+    assert 'system.multicall' not in metrics.methods
+    assert 2 == metrics.methods['list_users']['objects']
+    assert 100 == metrics.methods['list_users']['bytes']
+    assert 1 == metrics.methods['deletions']['errors']
+    assert 1 == metrics.methods['list_nodes']['calls']
+    proxy.system.multicall.side_effect = xmlrpclib.Fault(1, 'unsupported')
+    with pytest.raises(xmlrpclib.Fault):
+        d.system.multicall([{'methodName': 'list_users', 'params': []}])
+    assert 1 == metrics.methods['system.multicall']['errors']
+    assert 1 == metrics.methods['list_users']['calls']
+
+
+def test_instrumented_directory_counts_bytes_per_request():
+    transport = FakeTransport()
+    proxy = mock.Mock()
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def list_nodes():
+        received = transport.receive(1000)
+        started.set()
+        proceed.wait()
+        received.wire += 1000
+        return []
+
+    def list_users(rg):
+        transport.receive(10)
+        return []
+    proxy.list_nodes.side_effect = list_nodes
+    proxy.list_users.side_effect = list_users
+    metrics = DirectoryMetrics()
+    d = InstrumentedDirectory(proxy, transport, metrics)
+    t = threading.Thread(target=d.list_nodes)
+    t.start()
+    started.wait()
+    d.list_users('test')
+    proceed.set()
+    t.join()
+    assert 10 == metrics.methods['list_users']['bytes']
+    assert 2000 == metrics.methods['list_nodes']['bytes']
+
+
+def test_instrumented_directory_counts_streamed_objects():
+    metrics = DirectoryMetrics()
+    proxy = mock.Mock()
+    proxy.list_nodes.return_value = (n for n in range(5))
+    d = InstrumentedDirectory(proxy, FakeTransport(), metrics)
+    result = d.list_nodes()
+    assert 'list_nodes' not in metrics.methods
+    assert [0, 1, 2, 3, 4] == list(result)
+    assert 5 == metrics.methods['list_nodes']['objects']
+
+
+def test_metrics_textfile_and_log(tmpdir, monkeypatch):
+    monkeypatch.setenv('DIRECTORY_METRICS_DIR', str(tmpdir))
+    monkeypatch.setenv('DIRECTORY_METRICS_LOG', str(tmpdir / 'log.json'))
+    metrics = DirectoryMetrics()
+    metrics.write('localconfig-users')
+    assert [] == tmpdir.listdir()
+    metrics.record('list_users', 0.5, 1024, 3)
+    metrics.write('localconfig-users')
+    prom = (tmpdir / 'fc-agent-directory-localconfig-users.prom').read()
+    assert ('fc_agent_directory_bytes{script="localconfig-users",'
+            'method="list_users"} 1024\n') in prom
+    assert '# TYPE fc_agent_directory_calls gauge\n' in prom
+    log = json.loads((tmpdir / 'log.json').read())
+    assert 3 == log['methods']['list_users']['objects']
+
+
+def expire(cache, method, args, age):
+    old = time.time() - age
+    os.utime(cache._filename(method, args), (old, old))
+
+
+def test_stale_entries_are_served_and_revalidated(cache):
+    cache.set('deletions', ('vm',), {'node00': {'stages': ['soft']}})
+    expire(cache, 'deletions', ('vm',), 120)
+    proxy = mock.Mock()
+    proxy.deletions.return_value = {}
+    metrics = DirectoryMetrics()
+    d = CachedDirectory(proxy, cache, stale_ttl=3600, metrics=metrics)
+    with mock.patch('threading.Thread') as thread:
+        assert {'node00': {'stages': ['soft']}} == d.deletions('vm')
+    assert {'deletions'} == d.stale
+    assert 1 == metrics.methods['deletions']['stale']
+    assert not proxy.deletions.called
+    # run background refresh
+    thread.call_args[1]['target'](*thread.call_args[1]['args'])
+    assert {} == cache.get('deletions', ('vm',))
+
+
+def test_fresh_data_is_served_if_refresh_is_quick(cache):
+    cache.set('deletions', ('vm',), {'node00': {'stages': ['soft']}})
+    expire(cache, 'deletions', ('vm',), 120)
+    proxy = mock.Mock()
+    proxy.deletions.return_value = {}
+    metrics = DirectoryMetrics()
+    d = CachedDirectory(proxy, cache, stale_ttl=3600, metrics=metrics,
+                        stale_wait=5)
+    assert {} == d.deletions('vm')
+    assert set() == d.stale
+    assert 'deletions' not in metrics.methods
+
+
+def test_hanging_refresh_does_not_block_exit(cache, tmpdir):
+    script = """
+import gocept.net.directory, os, sys, time
+cache = gocept.net.directory.DirectoryCache(sys.argv[1], ttl=60)
+cache.set('deletions', ('vm',), {})
+old = time.time() - 120
+os.utime(cache._filename('deletions', ('vm',)), (old, old))
+
+class Hanging(object):
+    def deletions(self, *args):
+        time.sleep(300)
+
+d = gocept.net.directory.CachedDirectory(
+    Hanging(), cache, stale_ttl=3600, stale_wait=0.5,
+    metrics=gocept.net.directory.DirectoryMetrics())
+print(d.deletions('vm'))
+"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    start = time.time()
+    out = subprocess.check_output(
+        [sys.executable, '-c', script, str(tmpdir / 'cache2')], env=env)
+    assert '{}\n' == out
+    assert time.time() - start < 30
+
+
+def test_stale_refresh_failure_is_not_fatal(cache):
+    cache.set('deletions', ('vm',), {})
+    expire(cache, 'deletions', ('vm',), 120)
+    proxy = mock.Mock()
+    proxy.deletions.side_effect = IOError('timed out')
+    d = CachedDirectory(proxy, cache, stale_ttl=3600,
+                        metrics=DirectoryMetrics())
+    with mock.patch('threading.Thread') as thread:
+        assert {} == d.deletions('vm')
+    thread.call_args[1]['target'](*thread.call_args[1]['args'])
+    assert 1 == proxy.deletions.call_count
+    with pytest.raises(KeyError):
+        cache.get('deletions', ('vm',))
+
+
+def test_stale_entries_are_refused_without_stale_ttl(cache):
+    cache.set('deletions', ('vm',), {'node00': {'stages': ['soft']}})
+    expire(cache, 'deletions', ('vm',), 120)
+    proxy = mock.Mock()
+    proxy.deletions.return_value = {}
+    d = CachedDirectory(proxy, cache)
+    assert {} == d.deletions('vm')
+    assert set() == d.stale
+
+
+def test_too_old_entries_are_not_served_stale(cache):
+    cache.set('deletions', ('vm',), {'node00': {'stages': ['soft']}})
+    expire(cache, 'deletions', ('vm',), 7200)
+    proxy = mock.Mock()
+    proxy.deletions.return_value = {}
+    d = CachedDirectory(proxy, cache, stale_ttl=3600)
+    assert {} == d.deletions('vm')
+
+
+def test_batch_serves_stale_entries(cache):
+    cache.set('list_permissions', (), [{'name': 'wheel'}])
+    expire(cache, 'list_permissions', (), 120)
+    proxy = mock.Mock()
+    proxy.system.multicall.return_value = [[['alice']]]
+    proxy.list_permissions.return_value = []
+    d = CachedDirectory(proxy, cache, stale_ttl=3600,
+                        metrics=DirectoryMetrics())
+    batch = Batch(d)
+    batch.list_users('test')
+    batch.list_permissions()
+    with mock.patch('threading.Thread') as thread:
+        assert [['alice'], [{'name': 'wheel'}]] == batch()
+    proxy.system.multicall.assert_called_once_with([
+        {'methodName': 'list_users', 'params': ('test',)}])
+    assert [(([('list_permissions', ())],),)] == [
+        (c[1]['args'],) for c in thread.call_args_list]
+
+
+def test_incremental_listing_falls_back_to_full_fetch():
+    proxy = mock.Mock()
+    proxy.list_nodes_changed_since.side_effect = xmlrpclib.Fault(
+        -32601, 'method not supported')
+    proxy.list_nodes.return_value = [{'name': 'vm01'}, {'name': 'vm00'}]
+    listing = IncrementalListing(proxy, 'test', 'list_nodes')
+    assert [{'name': 'vm00'}, {'name': 'vm01'}] == listing.fetch()
+    assert listing.changed
+    listing.commit()
+    listing = IncrementalListing(proxy, 'test', 'list_nodes')
+    listing.fetch()
+    assert not listing.changed
+    proxy.list_nodes.return_value = [{'name': 'vm00', 'x': 1}]
+    listing.fetch()
+    assert listing.changed
+    proxy.list_nodes_changed_since.assert_called_once_with('')
+
+
+def test_incremental_listing_probes_for_changes_again_later(monkeypatch):
+    proxy = mock.Mock()
+    proxy.list_nodes_changed_since.side_effect = xmlrpclib.Fault(
+        -32601, 'method not supported')
+    proxy.list_nodes.return_value = [{'name': 'vm00'}]
+    listing = IncrementalListing(proxy, 'test', 'list_nodes')
+    listing.fetch()
+    listing.commit()
+    listing = IncrementalListing(proxy, 'test', 'list_nodes')
+    listing.fetch()
+    listing.commit()
+    assert 1 == proxy.list_nodes_changed_since.call_count
+    monkeypatch.setenv('DIRECTORY_DELTA_PROBE_INTERVAL', '0')
+    proxy.list_nodes_changed_since.side_effect = None
+    proxy.list_nodes_changed_since.return_value = {
+        'watermark': '1', 'changed': [{'name': 'vm00'}], 'deleted': []}
+    listing = IncrementalListing(proxy, 'test', 'list_nodes')
+    listing.fetch()
+    assert not listing.changed
+    assert 2 == proxy.list_nodes_changed_since.call_count
+    assert 2 == proxy.list_nodes.call_count
+
+
+def test_incremental_listing_merges_changes():
+    proxy = mock.Mock()
+    proxy.list_virtual_machines_changed_since.return_value = {
+        'watermark': '1', 'changed': [{'name': 'vm00'}, {'name': 'vm01'}],
+        'deleted': []}
+    listing = IncrementalListing(
+        proxy, 'test', 'list_virtual_machines', 'dev')
+    listing.fetch()
+    listing.commit()
+    proxy.list_virtual_machines_changed_since.return_value = {
+        'watermark': '2', 'changed': [{'name': 'vm02'}],
+        'deleted': ['vm00']}
+    listing = IncrementalListing(
+        proxy, 'test', 'list_virtual_machines', 'dev')
+    assert [{'name': 'vm01'}, {'name': 'vm02'}] == listing.fetch()
+    assert listing.changed
+    proxy.list_virtual_machines_changed_since.assert_called_with('dev', '1')
+    listing.commit()
+    proxy.list_virtual_machines_changed_since.return_value = {
+        'watermark': '3', 'changed': [], 'deleted': []}
+    listing = IncrementalListing(
+        proxy, 'test', 'list_virtual_machines', 'dev')
+    assert [{'name': 'vm01'}, {'name': 'vm02'}] == listing.fetch()
+    assert not listing.changed
+    assert not proxy.list_virtual_machines.called
+
+
+def test_incremental_listing_without_commit_reports_changes_again():
+    proxy = mock.Mock()
+    proxy.list_nodes_changed_since.return_value = {
+        'watermark': '1', 'changed': [{'name': 'vm00'}], 'deleted': []}
+    IncrementalListing(proxy, 'test', 'list_nodes').fetch()
+    listing = IncrementalListing(proxy, 'test', 'list_nodes')
+    listing.fetch()
+    assert listing.changed
+
+
+def test_gather_runs_calls_concurrently():
+    barrier = []
+    event = threading.Event()
+
+    def wait(name):
+        barrier.append(name)
+        if len(barrier) == 3:
+            event.set()
+        assert event.wait(5), 'calls did not run concurrently'
+        return name.upper()
+    proxy = mock.Mock()
+    proxy.lookup_resourcegroup.side_effect = wait
+    assert ['A', 'B', 'C'] == gocept.net.directory.gather(proxy, [
+        ('lookup_resourcegroup', ('a',)),
+        ('lookup_resourcegroup', ('b',)),
+        ('lookup_resourcegroup', ('c',))])
+
+
+def test_gather_raises_first_failure():
+    proxy = mock.Mock()
+    proxy.list_users.side_effect = xmlrpclib.Fault(1, 'no such group')
+    with pytest.raises(xmlrpclib.Fault):
+        gocept.net.directory.gather(proxy, [
+            ('list_permissions', ()), ('list_users', ('nonexistent',))])
+
+
+def test_concurrent_directory_returns_async_results():
+    proxy = mock.Mock()
+    proxy.list_permissions.return_value = [{'name': 'wheel'}]
+    with gocept.net.directory.ConcurrentDirectory(proxy, 2) as d:
+        result = d.list_permissions()
+    assert [{'name': 'wheel'}] == result.get()
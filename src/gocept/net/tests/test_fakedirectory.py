@@ -0,0 +1,107 @@
+from gocept.net.fakedirectory import Fixture, generate, record
+import gocept.net.configure.iptables
+import gocept.net.configure.zones
+import gocept.net.directory
+import gocept.net.fakedirectory
+import gocept.net.xmlrpc
+import mock
+import pytest
+import threading
+import xmlrpclib
+
+
+@pytest.fixture
+def fake(tmpdir, monkeypatch):
+    """Fake directory server running a small synthetic fixture."""
+    server = gocept.net.fakedirectory.server(generate(nodes=50, users=3))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    secret = tmpdir / 'directory.secret'
+    secret.write('secret\n')
+    monkeypatch.setenv('DIRECTORY_SERVER', 'http://{}:{}/'.format(
+        *server.server_address[:2]))
+    monkeypatch.setenv('DIRECTORY_SECRET', str(secret))
+    yield server
+    gocept.net.xmlrpc.pool.clear()
+    server.shutdown()
+    server.server_close()
+
+
+def test_generated_fixture_is_consistent():
+    fixture = generate(nodes=1000, resource_groups=5, users=2)
+    nodes = fixture.lookup('list_nodes', [])
+    assert 1000 == len(nodes)
+    assert nodes == fixture.lookup('list_virtual_machines', ['dev'])
+    names = set(n['name'] for n in nodes)
+    assert set(fixture.lookup('deletions', ['vm'])) <= names
+    addresses = fixture.lookup('list_nodes_addresses', ['dev', '', 4])
+    assert 2000 == len(set(a['ip'] for a in addresses))
+    assert 2 == len(fixture.lookup('list_users', ['rg004']))
+    assert 10 == len(fixture.lookup('list_users', []))
+    assert names == set(fixture.lookup(
+        'class_map', ['backupclient', 'location']))
+    srv = fixture.lookup('list_addresses', ['srv', 'dev'])
+    assert 2000 == len(srv)
+    assert set(['rg000', 'rg004']) <= set(a['rg'] for a in srv)
+    # deterministic
+    assert fixture.responses == generate(
+        nodes=1000, resource_groups=5, users=2).responses
+
+
+def test_fixture_save_load(tmpdir):
+    fixture = Fixture()
+    fixture.add('deletions', ('vm',), {'vm00': {'stages': ['soft']}})
+    fixture.add('deletions', ('vm',), {})
+    fixture.save(str(tmpdir / 'fixture.xml'))
+    loaded = Fixture.load(str(tmpdir / 'fixture.xml'))
+    assert {} == loaded.lookup('deletions', ['vm'])
+    with pytest.raises(KeyError):
+        loaded.lookup('deletions', ['srv'])
+
+
+def test_record_captures_responses():
+    proxy = mock.Mock()
+    proxy.list_nodes.return_value = [{'name': 'vm00'}]
+    proxy.list_users.return_value = []
+    fixture = record(proxy, 'dev', ['test'])
+    assert [{'name': 'vm00'}] == fixture.lookup('list_nodes', [])
+    assert [] == fixture.lookup('list_users', ['test'])
+    proxy.list_nodes_addresses.assert_any_call('dev', '', 6)
+    proxy.list_users.assert_any_call()
+    proxy.class_map.assert_called_with('backupclient', 'location')
+    proxy.list_addresses.assert_any_call('srv', 'dev')
+
+
+def test_generate_deleted_fraction():
+    assert {} == generate(nodes=100, deleted=0).lookup('deletions', ['vm'])
+    assert 100 == len(generate(nodes=100, deleted=1).lookup(
+        'deletions', ['vm']))
+
+
+def test_directory_talks_to_fake_server(fake):
+    d = gocept.net.directory.Directory(cache_ttl=0)
+    assert 50 == len(d.list_nodes())
+    assert {'a': {'time': None}} == d.schedule_maintenance({'a': {}})
+    with pytest.raises(xmlrpclib.Fault):
+        d.list_users('nonexistent')
+    batch = gocept.net.directory.Batch(d)
+    batch.list_users('rg001')
+    batch.lookup_resourcegroup('rg001')
+    users, rg = batch()
+    assert 3 == len(users)
+    assert 4001 == rg['gid']
+
+
+def test_zones_walk_streams_from_fake_server(fake):
+    d = gocept.net.directory.Directory(cache_ttl=0, streaming=True)
+    addrs = list(gocept.net.configure.zones.walk(d))
+    assert 200 == len(addrs)
+
+
+def test_iptables_queries_fake_server(fake):
+    iptables = gocept.net.configure.iptables.Iptables(
+        'dev', 'rg001', 'ethsrv', 'srv')
+    addrs = list(iptables.rg_addresses())
+    assert 6 == len(addrs)
+    assert set([4, 6]) == set(a.version for a in addrs)
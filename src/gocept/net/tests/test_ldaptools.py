@@ -0,0 +1,40 @@
+from gocept.net.ldaptools import CountingServer, search
+from ldap.controls import SimplePagedResultsControl
+import ldap
+import mock
+
+
+def test_search_retrieves_results_in_bulk():
+    server = mock.Mock()
+    server.result3.return_value = (ldap.RES_SEARCH_RESULT, [
+        ('uid=alice,ou=People', {'uid': ['alice']}),
+        (None, ['ldap://other/ou=People'])], 1, [])
+    assert [{'uid': ['alice']}] == list(search(
+        server, 'ou=People', '(uid=*)', attrlist=['uid']))
+    server.search_ext.assert_called_once_with(
+        'ou=People', ldap.SCOPE_ONELEVEL, '(uid=*)', ['uid'])
+    assert 1 == server.result3.call_count
+
+
+def test_search_pages_through_results():
+    server = mock.Mock()
+
+    def page(cookie):
+        control = mock.Mock(controlType=SimplePagedResultsControl.controlType,
+                            cookie=cookie)
+        return [control]
+    server.result3.side_effect = [
+        (ldap.RES_SEARCH_RESULT, [('cn=a,ou=Group', {'cn': ['a']})], 1,
+         page('next')),
+        (ldap.RES_SEARCH_RESULT, [('cn=b,ou=Group', {'cn': ['b']})], 2,
+         page(''))]
+    cookies = []
+    server.search_ext.side_effect = (
+        lambda *args, **kw: cookies.append(kw['serverctrls'][0].cookie))
+    counting = CountingServer(server)
+    assert [('cn=a,ou=Group', {'cn': ['a']}),
+            ('cn=b,ou=Group', {'cn': ['b']})] == list(search(
+                counting, 'ou=Group', '(cn=*)', scope=ldap.SCOPE_SUBTREE,
+                dn=True, page_size=1))
+    assert ['', 'next'] == cookies
+    assert 2 == counting.searches
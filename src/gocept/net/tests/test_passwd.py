@@ -112,6 +112,22 @@ adm:x:3:ctheune,root,zagy
         self.assertEquals('root:x:0:0:root:/root:/bin/bash\n',
                           open(self.pwd_file).read())
 
+    def test_save_returns_diff_and_keeps_backup(self):
+        os.chmod(self.grp_file, 0o644)
+        self.grp.get('adm').members = 'root'
+        changed, diff = self.grp.save()
+        self.assertTrue(changed)
+        self.assertEqual(['--- old\n', '+++ new\n', '@@ -1,2 +1,2 @@\n',
+                          ' root:x:0:\n', '-adm:x:3:ctheune,root,zagy\n',
+                          '+adm:x:3:root\n'], diff)
+        self.assertEqual('root:x:0:\nadm:x:3:root\n',
+                         open(self.grp_file).read())
+        self.assertEqual('root:x:0:\nadm:x:3:ctheune,root,zagy\n',
+                         open(self.grp_file + '-').read())
+        self.assertEqual(0o644, os.stat(self.grp_file).st_mode & 0o777)
+        self.assertFalse(os.path.exists(self.grp_file + '+'))
+        self.assertEqual((False, []), self.grp.save())
+
     def test_get_group_by_name(self):
         adm = self.grp.get('adm')
         self.assertEquals('adm', adm.group)
@@ -148,3 +164,109 @@ class ShadowTest(unittest.TestCase):
             shadow = gocept.net.passwd.Shadow(tf.name)
             u = shadow.get('user', create=True)
             self.assertEqual(u.lastchange, '16164')
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pwd_file = os.path.join(self.directory, 'passwd')
+        self.pwd = self.passwd(100)
+
+    def tearDown(self):
+        self.pwd.close()
+        shutil.rmtree(self.directory)
+
+    def passwd(self, count):
+        with open(self.pwd_file, 'w') as f:
+            for i in range(count):
+                f.write('user{0}:x:{0}:100::/home/user{0}:/bin/bash\n'.format(
+                    1000 + i))
+        return gocept.net.passwd.Passwd(self.pwd_file)
+
+    def test_lookups_in_large_database(self):
+        self.pwd.close()
+        self.pwd = self.passwd(50000)
+        for i in range(0, 50000, 7):
+            entry = self.pwd.get('user{}'.format(1000 + i))
+            self.assertEqual(str(1000 + i), entry.uid)
+        self.assertEqual(['user1042'],
+                         [e.login_name for e in self.pwd.find('uid', '1042')])
+        self.assertRaises(KeyError, self.pwd.get, 'nobody')
+
+    def test_index_follows_create_and_remove(self):
+        new = self.pwd.get('new', create=True)
+        self.assertIs(new, self.pwd.get('new'))
+        new.uid = '99999'
+        self.assertEqual([new], self.pwd.find('uid', '99999'))
+        self.pwd.records.remove(new)
+        self.assertRaises(KeyError, self.pwd.get, 'new')
+        self.assertEqual([], self.pwd.find('uid', '99999'))
+        del self.pwd.records[0]
+        self.assertRaises(KeyError, self.pwd.get, 'user1000')
+
+    def test_index_follows_field_changes(self):
+        entry = self.pwd.get('user1001')
+        entry.login_name = 'renamed'
+        entry.uid = '1'
+        self.assertIs(entry, self.pwd.get('renamed'))
+        self.assertRaises(KeyError, self.pwd.get, 'user1001')
+        self.assertEqual([entry], self.pwd.find('uid', '1'))
+        self.assertEqual([], self.pwd.find('uid', '1001'))
+
+    def test_index_follows_records_appended_by_hand(self):
+        entry = gocept.net.passwd.PasswdEntry('appended')
+        self.pwd.records.append(entry)
+        self.assertIs(entry, self.pwd.get('appended'))
+        self.pwd.records = [entry]
+        self.assertRaises(KeyError, self.pwd.get, 'user1000')
+        self.assertIs(entry, self.pwd.get('appended'))
+
+    def test_first_entry_wins_for_duplicate_keys(self):
+        dup = gocept.net.passwd.PasswdEntry('user1000')
+        self.pwd.records.append(dup)
+        self.assertIsNot(dup, self.pwd.get('user1000'))
+        self.pwd.records.remove(self.pwd.get('user1000'))
+        self.assertIs(dup, self.pwd.get('user1000'))
+
+
+class EntryTest(unittest.TestCase):
+
+    def test_entries_have_no_instance_dict(self):
+        entry = gocept.net.passwd.PasswdEntry.fromString(
+            'root:x:0:0:root:/root:/bin/bash')
+        self.assertFalse(hasattr(entry, '__dict__'))
+        with self.assertRaises(AttributeError):
+            entry.nonexistent = 1
+
+    def test_fields_are_split_on_first_change(self):
+        line = 'root:x:0:0:root:/root:/bin/bash '
+        entry = gocept.net.passwd.PasswdEntry.fromString(line)
+        self.assertEqual('0', entry.uid)
+        self.assertIsNone(entry._values)
+        entry.uid = '0'
+        self.assertIs(line, entry.toString())
+        entry.shell = '/bin/sh'
+        self.assertEqual('root:x:0:0:root:/root:/bin/sh', entry.toString())
+
+    def test_unset_fields(self):
+        entry = gocept.net.passwd.PasswdEntry('root')
+        self.assertFalse(hasattr(entry, 'uid'))
+        self.assertEqual('/bin/bash', entry.shell)
+        self.assertRaises(AttributeError, entry.toString)
+
+    def test_untouched_lines_are_written_back_verbatim(self):
+        directory = tempfile.mkdtemp()
+        try:
+            grp_file = os.path.join(directory, 'group')
+            contents = 'root::0:root \nadm:x:3:zagy,ctheune\n'
+            with open(grp_file, 'w') as f:
+                f.write(contents)
+            grp = gocept.net.passwd.Group(grp_file)
+            grp.get('adm').members = 'zagy,ctheune'
+            grp.get('new', create=True).gid = '4'
+            grp.save()
+            grp.close()
+            self.assertEqual(contents + 'new:x:4:\n', open(grp_file).read())
+        finally:
+            shutil.rmtree(directory)
@@ -8,6 +8,7 @@ import pytz
 import shutil
 import tempfile
 import unittest
+import xmlrpclib
 
 
 sanitize = gocept.net.configure.users.sanitize_password
@@ -53,9 +54,14 @@ class TestUserConfig(unittest.TestCase):
                            'test': {'gid': 2, 'name': 'test'}}
         self.fake_directory().lookup_resourcegroup = (
             resource_groups.__getitem__)
+        # Exercise the sequential fallback for batched directory calls.
+        self.fake_directory().system.multicall.side_effect = xmlrpclib.Fault(
+            -32601, 'method "system.multicall" is not supported')
 
         self.p_chown = mock.patch('os.chown')
         self.chown = self.p_chown.start()
+        self.p_fchown = mock.patch('os.fchown')
+        self.p_fchown.start()
 
         self.tmpdir = tempfile.mkdtemp()
         os.mkdir(self.tmpdir + '/etc')
@@ -69,6 +75,8 @@ class TestUserConfig(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
         self.p_directory.stop()
+        self.p_chown.stop()
+        self.p_fchown.stop()
 
     @mock.patch('gocept.net.utils.now')
     def test_workflow(self, _now):
@@ -153,3 +161,35 @@ admins:x:1:tom
         configuration.ensure_rg_unix_group()
         with pytest.raises(ValueError):
             configuration.ensure_users()
+
+    def test_permission_groups_updated_in_one_pass(self):
+        with open(self.tmpdir + '/etc/group', 'w') as f:
+            f.write('login:x:3:local,gone,carol\nadmins:x:1:gone\n')
+        with open(self.tmpdir + '/etc/passwd', 'w') as f:
+            f.write('gone:x:1001:100::/home/gone:/bin/bash\n')
+        with open(self.tmpdir + '/etc/shadow', 'w') as f:
+            f.write('gone:x:16161:0:99999:7:::\n')
+        self.fake_directory().list_permissions.return_value = [
+            {'name': 'login', 'id': 3}]
+        self.fake_directory().list_users.return_value = [
+            {'uid': uid, 'id': 10 + i, 'gid': 100, 'name': uid,
+             'login_shell': '/bin/bash', 'home_directory': '/home/' + uid,
+             'password': '', 'ssh_pubkey': [],
+             'permissions': {'test': permissions}}
+            for i, (uid, permissions) in enumerate([
+                ('alice', ['login', 'admins']),
+                ('bob', ['login']),
+                ('carol', [])])]
+
+        configuration = gocept.net.configure.users.UserConfig(
+            'test', prefix=self.tmpdir)
+        configuration.ensure_permission_groups()
+        configuration.ensure_users()
+        configuration.finish()
+
+        group = open(self.tmpdir + '/etc/group', 'r').read()
+        self.assertEqual(group, """\
+login:x:3:alice,bob,local
+admins:x:1:alice
+""")
+        self.assertNotIn('gone', open(self.tmpdir + '/etc/passwd').read())
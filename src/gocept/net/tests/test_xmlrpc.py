@@ -1,8 +1,26 @@
 # Copyright (c) 2009 gocept gmbh & co. kg
 # See also LICENSE.txt
 
-import unittest
+import SimpleXMLRPCServer
+import SocketServer
 import gocept.net.xmlrpc
+import threading
+import unittest
+import xmlrpclib
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn,
+                      SimpleXMLRPCServer.SimpleXMLRPCServer):
+
+    daemon_threads = True
+
+
+class KeepAliveHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
 
 
 class TestLoginTransport(unittest.TestCase):
@@ -16,5 +34,192 @@ class TestLoginTransport(unittest.TestCase):
         self.assertEquals({}, x509)
 
 
+def chunked(data, size=7):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestIterparse(unittest.TestCase):
+
+    def finish(self, success):
+        self.finished.append(success)
+
+    def setUp(self):
+        self.finished = []
+
+    def test_array_elements_are_generated_one_by_one(self):
+        value = [{'name': 'node00', 'ips': ['1.2.3.4']}, 'x', [], 3]
+        parser = gocept.net.xmlrpc.StreamingParser()
+        data = xmlrpclib.dumps((value,), methodresponse=True)
+        parser.feed(data[:data.index('<value><string>x')])
+        self.assertEquals([{'name': 'node00', 'ips': ['1.2.3.4']}],
+                          parser.pop())
+        self.assertEquals([], parser.pop())
+
+    def test_iterparse_array(self):
+        value = [{'name': u'n\xf6de', 'ips': ['1.2.3.4']}, 'x', [], 3]
+        result = gocept.net.xmlrpc.iterparse(chunked(
+            xmlrpclib.dumps((value,), methodresponse=True)), self.finish)
+        self.assertFalse(isinstance(result, list))
+        self.assertEquals([], self.finished)
+        self.assertEquals(value, list(result))
+        self.assertEquals([True], self.finished)
+
+    def test_iterparse_returns_plain_values(self):
+        value = {'srv': [{'cidr': '10.0.0.0/24', 'list': [1, 2]}]}
+        result = gocept.net.xmlrpc.iterparse(chunked(
+            xmlrpclib.dumps((value,), methodresponse=True)), self.finish)
+        self.assertEquals(value, result)
+        self.assertEquals([True], self.finished)
+
+    def test_iterparse_raises_faults(self):
+        with self.assertRaises(xmlrpclib.Fault):
+            gocept.net.xmlrpc.iterparse(chunked(xmlrpclib.dumps(
+                xmlrpclib.Fault(1, 'error'), methodresponse=True)),
+                self.finish)
+        self.assertEquals([True], self.finished)
+
+    def test_abandoned_iterator_reports_failure(self):
+        result = gocept.net.xmlrpc.iterparse(chunked(xmlrpclib.dumps(
+            ([1, 2, 3],), methodresponse=True)), self.finish)
+        self.assertEquals(1, next(result))
+        result.close()
+        self.assertEquals([False], self.finished)
+
+
+class TestPersistentTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingServer(
+            ('127.0.0.1', 0), KeepAliveHandler, logRequests=False)
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.server.register_function(self.fail_call, 'fail')
+        self.server.register_function(len, 'length')
+        self.server.register_function(range, 'range')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+        self.pool = gocept.net.xmlrpc.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_call(self):
+        raise ValueError('fail')
+
+    def proxy(self):
+        return xmlrpclib.ServerProxy(
+            self.url, transport=gocept.net.xmlrpc.PersistentTransport(
+                'http', read_timeout=5, pool=self.pool))
+
+    def test_connection_is_shared_between_proxies(self):
+        self.assertEquals(2, self.proxy().double(1))
+        self.assertEquals(4, self.proxy().double(2))
+        self.assertEquals(6, self.proxy().double(3))
+        stats = self.pool.statistics()
+        self.assertEquals(1, len(stats))
+        self.assertEquals(1, stats[0]['connects'])
+        self.assertEquals(3, stats[0]['requests'])
+
+    def test_connection_survives_fault(self):
+        proxy = self.proxy()
+        with self.assertRaises(xmlrpclib.Fault):
+            proxy.fail()
+        self.assertEquals(2, proxy.double(1))
+        self.assertEquals([{'host': '127.0.0.1', 'connects': 1,
+                            'requests': 2}], self.pool.statistics())
+
+    def test_large_responses_are_compressed(self):
+        transport = gocept.net.xmlrpc.PersistentTransport(
+            'http', read_timeout=5, pool=self.pool)
+        proxy = xmlrpclib.ServerProxy(self.url, transport=transport)
+        self.assertEquals('abc' * 10000, proxy.double('abc' * 5000))
+        self.assertTrue(transport.decoded_bytes > 30000)
+        self.assertTrue(transport.wire_bytes < transport.decoded_bytes / 10)
+
+    def test_bytes_are_counted_per_request(self):
+        transport = gocept.net.xmlrpc.PersistentTransport(
+            'http', read_timeout=5, pool=self.pool)
+        proxy = xmlrpclib.ServerProxy(self.url, transport=transport)
+        proxy.double('abc' * 5000)
+        first = transport.current.received
+        proxy.double(1)
+        second = transport.current.received
+        self.assertEquals(transport.wire_bytes, first.wire + second.wire)
+        self.assertTrue(0 < second.wire < first.wire)
+
+    def test_small_responses_are_not_compressed(self):
+        transport = gocept.net.xmlrpc.PersistentTransport(
+            'http', read_timeout=5, pool=self.pool)
+        proxy = xmlrpclib.ServerProxy(self.url, transport=transport)
+        self.assertEquals(2, proxy.double(1))
+        self.assertEquals(transport.wire_bytes, transport.decoded_bytes)
+
+    def test_compressed_requests(self):
+        transport = gocept.net.xmlrpc.PersistentTransport(
+            'http', read_timeout=5, pool=self.pool)
+        transport.encode_threshold = 1000
+        proxy = xmlrpclib.ServerProxy(self.url, transport=transport)
+        self.assertEquals(50000, proxy.length('a' * 50000))
+
+    def test_streaming(self):
+        transport = gocept.net.xmlrpc.PersistentTransport(
+            'http', read_timeout=5, pool=self.pool, streaming=True)
+        transport.chunk_size = 100
+        proxy = xmlrpclib.ServerProxy(self.url, transport=transport)
+        result = proxy.range(10000)
+        self.assertEquals(0, next(result))
+        # The connection stays busy until the result has been consumed.
+        self.assertEquals({}, self.pool.idle)
+        self.assertEquals(range(1, 10000), list(result))
+        self.assertEquals(2, proxy.double(1))
+        self.assertEquals([{'host': '127.0.0.1', 'connects': 1,
+                            'requests': 2}], self.pool.statistics())
+
+    def test_reconnect_if_pooled_connection_was_closed(self):
+        proxy = self.proxy()
+        self.assertEquals(2, proxy.double(1))
+        # Simulate the server dropping the idle connection.
+        for conns in self.pool.idle.values():
+            for conn in conns:
+                conn.sock.close()
+        self.assertEquals(4, proxy.double(2))
+
+    def test_discarded_connections_are_forgotten(self):
+        proxy = self.proxy()
+        self.assertEquals(2, proxy.double(1))
+        for conns in self.pool.idle.values():
+            for conn in conns:
+                conn.sock.close()
+        for i in range(5):
+            self.assertEquals(4, proxy.double(2))
+        self.assertEquals(1, len(self.pool.statistics()))
+        self.pool.clear()
+        self.assertEquals([], self.pool.statistics())
+
+    def test_surplus_connections_are_forgotten(self):
+        pool = gocept.net.xmlrpc.ConnectionPool(size=1)
+        conns = [pool.acquire('key', lambda: FakeConnection())
+                 for i in range(3)]
+        for conn in conns:
+            pool.release('key', conn)
+        self.assertEquals([conns[0]], pool.connections)
+        self.assertEquals([False, True, True], [c.closed for c in conns])
+
+
+class FakeConnection(object):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
 def test_suite():
-    return unittest.makeSuite(TestLoginTransport)
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLoginTransport))
+    suite.addTest(unittest.makeSuite(TestIterparse))
+    suite.addTest(unittest.makeSuite(TestPersistentTransport))
+    return suite
@@ -1,21 +1,435 @@
 # Copyright (c) 2012 gocept gmbh & co. kg
 # See also LICENSE.txt
 
+import httplib
+import logging
+import socket
+import threading
+import xml.parsers.expat
 import xmlrpclib
+import zlib
 
+_log = logging.getLogger(__name__)
 
-class LoginTransport(xmlrpclib.Transport):
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections shared by all transports of a process.
+
+    Idle connections are kept per scheme, host and timeout settings. At
+    most `size` idle connections per key are retained. Python 2's ssl
+    module cannot resume TLS sessions, so keeping connections open is
+    the only way to avoid repeated TLS handshakes.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.idle = {}
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def acquire(self, key, factory):
+        """Return an idle connection for `key` or create one via `factory`.
+        """
+        with self.lock:
+            try:
+                return self.idle[key].pop()
+            except (KeyError, IndexError):
+                pass
+        conn = factory()
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def release(self, key, conn):
+        """Return `conn` to the pool after a completed request."""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        """Close `conn` without returning it to the pool."""
+        with self.lock:
+            try:
+                self.connections.remove(conn)
+            except ValueError:
+                pass
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                self.discard(conn)
+
+    def statistics(self):
+        """List of per-connection counters of open connections.
+
+        Each entry contains host, number of (re-)connects and number of
+        requests. Requests exceeding connects have reused an open
+        connection.
+        """
+        with self.lock:
+            return [{'host': conn.host,
+                     'connects': conn.connects,
+                     'requests': conn.requests}
+                    for conn in self.connections]
+
+
+pool = ConnectionPool()
+
+
+class CountingConnectionMixin:
+    """Connection which applies a read timeout and counts its usage.
+
+    Old-style class like the httplib connections it is mixed into.
+
+    The `timeout` passed to the constructor limits connection
+    establishment. Once connected, the socket timeout is switched to
+    `read_timeout`.
+    """
+
+    read_timeout = None
+    connects = 0
+    requests = 0
+
+    def connect(self):
+        self._base.connect(self)
+        self.sock.settimeout(self.read_timeout)
+        self.connects += 1
+
+    def putrequest(self, *args, **kw):
+        self.requests += 1
+        return self._base.putrequest(self, *args, **kw)
+
+
+class HTTPConnection(CountingConnectionMixin, httplib.HTTPConnection):
+
+    _base = httplib.HTTPConnection
+
+
+class HTTPSConnection(CountingConnectionMixin, httplib.HTTPSConnection):
+
+    _base = httplib.HTTPSConnection
+
+
+class StreamingParser(object):
+    """Incremental parser for XML-RPC responses.
+
+    If the response is an array, its elements are decoded one at a time
+    and can be fetched with `pop` as soon as they are complete. Other
+    responses are decoded as a whole when calling `close`.
+    """
+
+    def __init__(self, use_datetime=0):
+        self.use_datetime = use_datetime
+        self.parser = xml.parsers.expat.ParserCreate(None, None)
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.data
+        self.target = self._unmarshaller()
+        self.tags = []
+        self.array_depth = None
+        self.values = []
+
+    def _unmarshaller(self):
+        u = xmlrpclib.Unmarshaller(self.use_datetime)
+        # Same as xmlrpclib.ExpatParser: text arrives as unicode already.
+        u.xml(None if self.parser.returns_unicode else 'utf-8', None)
+        return u
+
+    @property
+    def is_array(self):
+        return self.array_depth is not None
+
+    def start(self, tag, attrs):
+        self.tags.append(tag)
+        depth = len(self.tags)
+        if not self.is_array:
+            if tag == 'array' and self.tags[-3:-1] == ['param', 'value']:
+                self.array_depth = depth
+                self.target = None
+                return
+        elif (self.target is None and tag == 'value' and
+                depth == self.array_depth + 2):
+            # Start of an array element: decode it as if it was a
+            # complete parameter list on its own.
+            self.target = self._unmarshaller()
+            self.target.start('params', {})
+        if self.target is not None:
+            self.target.start(tag, attrs)
+
+    def data(self, text):
+        if self.target is not None:
+            self.target.data(text)
+
+    def end(self, tag):
+        depth = len(self.tags)
+        self.tags.pop()
+        if self.target is None:
+            return
+        self.target.end(tag)
+        if self.is_array and depth == self.array_depth + 2:
+            self.target.end('params')
+            self.values.append(self.target.close()[0])
+            self.target = None
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+
+    def pop(self):
+        """Return array elements decoded since the last call."""
+        values, self.values = self.values, []
+        return values
+
+    def close(self):
+        """Finish parsing. Returns the result unless it is an array.
+
+        Faults are raised as xmlrpclib.Fault.
+        """
+        self.parser.Parse('', True)
+        if not self.is_array:
+            return self.target.close()[0]
+
+
+def iterparse(chunks, finish=lambda success: None):
+    """Parse an XML-RPC response read piecewise from `chunks`.
+
+    Returns an iterator over the elements if the result is an array and
+    the result itself otherwise. Only the current chunk and element are
+    held in memory. `finish` is called with a success flag once `chunks`
+    has been read completely or reading has been aborted.
+    """
+    parser = StreamingParser()
+    chunks = iter(chunks)
+    try:
+        for data in chunks:
+            parser.feed(data)
+            if parser.is_array:
+                break
+        else:
+            result = parser.close()
+            finish(True)
+            return result
+    except xmlrpclib.Fault:
+        finish(True)
+        raise
+    except BaseException:
+        finish(False)
+        raise
+    return _iterelements(parser, chunks, finish)
+
+
+def _iterelements(parser, chunks, finish):
+    success = False
+    try:
+        for value in parser.pop():
+            yield value
+        for data in chunks:
+            parser.feed(data)
+            for value in parser.pop():
+                yield value
+        parser.close()
+        for value in parser.pop():
+            yield value
+        success = True
+    finally:
+        finish(success)
+
+
+class RequestCounter(object):
+    """Wire bytes received for a single request."""
+
+    def __init__(self):
+        self.wire = 0
+
+
+class PersistentTransport(xmlrpclib.Transport):
+    """XML-RPC transport using pooled keep-alive connections.
+
+    All instances share the module-level connection `pool`, so that
+    consecutive calls in a process use the same HTTP/1.1 connection even
+    if they go through different ServerProxy objects. `connect_timeout`
+    and `read_timeout` are given in seconds.
+
+    Responses are requested gzip-compressed and decompressed while being
+    parsed. `wire_bytes` and `decoded_bytes` count received response
+    bytes before and after decompression. As calls may overlap in
+    several threads, `current.received` holds a separate counter of
+    wire bytes for the latest request of each thread. Requests larger than
+    `encode_threshold` are sent compressed, but as not every server
+    accepts this, request compression is off by default.
+
+    With `streaming` enabled, calls returning arrays return an iterator
+    over the elements instead (see `iterparse`). The connection is
+    occupied until the iterator has been exhausted.
+    """
+
+    connect_timeout = 10
+    read_timeout = 300
+    chunk_size = 65536
+
+    def __init__(self, scheme='https', connect_timeout=None,
+                 read_timeout=None, context=None, pool=pool,
+                 streaming=False):
+        xmlrpclib.Transport.__init__(self, use_datetime=0)
+        self.scheme = scheme
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        self.context = context
+        self.pool = pool
+        self.streaming = streaming
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.current = threading.local()
+
+    def _new_connection(self, host, x509):
+        if self.scheme == 'https':
+            conn = HTTPSConnection(host, timeout=self.connect_timeout,
+                                   context=self.context, **(x509 or {}))
+        else:
+            conn = HTTPConnection(host, timeout=self.connect_timeout)
+        conn.read_timeout = self.read_timeout
+        return conn
+
+    def _finisher(self, key, conn):
+        """Callback which hands `conn` back to the pool exactly once."""
+        done = []
+
+        def finish(success):
+            if done:
+                return
+            done.append(success)
+            if success:
+                self.pool.release(key, conn)
+            else:
+                self.pool.discard(conn)
+        return finish
+
+    def request(self, host, handler, request_body, verbose=0):
+        chost, extra_headers, x509 = self.get_host_info(host)
+        if isinstance(extra_headers, dict):
+            extra_headers = extra_headers.items()
+        key = (self.scheme, chost, self.connect_timeout, self.read_timeout)
+        received = self.current.received = RequestCounter()
+        # Retry once if a pooled connection has been closed by the server.
+        for attempt in (0, 1):
+            conn = self.pool.acquire(
+                key, lambda: self._new_connection(chost, x509))
+            finish = self._finisher(key, conn)
+            reused = conn.requests > 0
+            if verbose:
+                conn.set_debuglevel(1)
+            try:
+                response = self._send(conn, handler, request_body,
+                                      extra_headers)
+                if response.status != 200:
+                    response.read()
+                elif self.streaming:
+                    return (iterparse(
+                        self._read(response, received), finish),)
+                else:
+                    self.verbose = verbose
+                    result = self._parse_response(response, received)
+            except xmlrpclib.Fault:
+                finish(True)
+                raise
+            except (socket.error, httplib.BadStatusLine) as e:
+                finish(False)
+                if reused and not attempt and not isinstance(
+                        e, socket.timeout):
+                    continue
+                raise
+            except Exception:
+                finish(False)
+                raise
+            finish(True)
+            if response.status != 200:
+                raise xmlrpclib.ProtocolError(
+                    host + handler, response.status, response.reason,
+                    response.msg)
+            return result
+
+    def _send(self, conn, handler, request_body, extra_headers):
+        conn.putrequest('POST', handler, skip_accept_encoding=True)
+        conn.putheader('Content-Type', 'text/xml')
+        conn.putheader('User-Agent', self.user_agent)
+        if self.accept_gzip_encoding:
+            conn.putheader('Accept-Encoding', 'gzip')
+        for key, value in extra_headers or ():
+            conn.putheader(key, value)
+        if (self.encode_threshold is not None and
+                len(request_body) > self.encode_threshold):
+            conn.putheader('Content-Encoding', 'gzip')
+            request_body = xmlrpclib.gzip_encode(request_body)
+        conn.putheader('Content-Length', str(len(request_body)))
+        conn.endheaders(request_body)
+        return conn.getresponse(buffering=True)
+
+    def _read(self, response, received=None):
+        """Generate response body chunks, decompressing them on the fly.
+
+        Received bytes are added to the `received` counter if given.
+        """
+        decoder = None
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        wire = decoded = 0
+        while True:
+            data = response.read(self.chunk_size)
+            if not data:
+                break
+            wire += len(data)
+            self.wire_bytes += len(data)
+            if received is not None:
+                received.wire += len(data)
+            if decoder:
+                data = decoder.decompress(data)
+            decoded += len(data)
+            self.decoded_bytes += len(data)
+            yield data
+        if decoder:
+            data = decoder.flush()
+            decoded += len(data)
+            self.decoded_bytes += len(data)
+            yield data
+        _log.debug('received %d bytes (%d bytes decoded)', wire, decoded)
+
+    def parse_response(self, response):
+        return self._parse_response(response)
+
+    def _parse_response(self, response, received=None):
+        p, u = self.getparser()
+        for data in self._read(response, received):
+            if self.verbose:
+                print 'body:', repr(data)
+            p.feed(data)
+        p.close()
+        return u.close()
+
+    def close(self):
+        """Connections belong to the pool and stay open."""
+        pass
+
+
+class LoginTransport(PersistentTransport):
 
     user = None
     password = None
 
-    def __init__(self, user, password):
+    def __init__(self, user, password, scheme='http'):
         self.user = user
         self.password = password
-        xmlrpclib.Transport.__init__(self, use_datetime=0)
+        PersistentTransport.__init__(self, scheme)
 
     def get_host_info(self, host):
-        host, extra_headers, x509 = xmlrpclib.Transport.get_host_info(
+        host, extra_headers, x509 = PersistentTransport.get_host_info(
             self, host)
         if self.user:
             if extra_headers is None: